@@ -3,6 +3,7 @@ from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.core.cache import cache
 from contact.utils import generate_image_path
+from event_ticketing.cache import bump_cache_version
 
 
 class ContactInfo(models.Model):
@@ -30,9 +31,8 @@ class SocialMedia(models.Model):
     url = models.URLField()
     icon = models.ImageField(upload_to=generate_image_path, null=True, blank=True)
 
-# @receiver(post_save, sender=SocialMedia)
-# @receiver(post_delete, sender=SocialMedia)
-# def clear_event_cache(sender, instance, **kwargs):
-#     # Clear cache for both list and retrieve actions
-#     cache.delete(f'social_media-list')
-#     cache.delete(f'social_media-details-{instance.id}')
+
+@receiver(post_save, sender=SocialMedia)
+@receiver(post_delete, sender=SocialMedia)
+def clear_social_media_cache(sender, instance, **kwargs):
+    bump_cache_version('social_media')
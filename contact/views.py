@@ -3,8 +3,7 @@ from rest_framework import viewsets, mixins, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.conf import settings
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from event_ticketing.cache import cache_response
 from contact.filters import ContactListOrderingBackend
 from contact.models import ContactInfo, SocialMedia
 from contact.serializers import ContactInfoSerializer, SendEmailSerializer, SocialMediaSerializer, \
@@ -69,14 +68,14 @@ class SocialMediaViewSet(viewsets.ModelViewSet):
             return SocialMediaDisplaySerializer
         return SocialMediaSerializer
 
-    @method_decorator(cache_page(60 * 5))
+    @cache_response('social_media')
     def retrieve(self, request, *args, **kwargs):
         """
         Cache the retrieve action
         """
         return super().retrieve(request, *args, **kwargs)
 
-    @method_decorator(cache_page(60 * 5))
+    @cache_response('social_media')
     def list(self, request, *args, **kwargs):
         """
         Cache the list action
@@ -0,0 +1,54 @@
+import math
+from statistics import median
+
+from django.db.models import F, Sum
+
+from event.models import TicketBatch, TicketBatchSlot
+
+
+class AdmissionController:
+    def __init__(self, event, queue_service, token_ttl):
+        """
+        Decide how many users an event admits on each tick.
+        :param event: The event whose queue is being admitted.
+        :param queue_service: QueueService of the event.
+        :param token_ttl: Lifetime of a booking token in seconds.
+        """
+        self.event = event
+        self.queue_service = queue_service
+        self.token_ttl = token_ttl
+
+    def get_remaining_tickets(self):
+        remaining = Sum(F('number_of_tickets') - F('tickets_sold'))
+        batches = TicketBatch.objects.filter(event=self.event).exclude(
+            inventory_mode=TicketBatch.InventoryModeChoices.SHARDED
+        ).aggregate(remaining=remaining)['remaining'] or 0
+        slots = TicketBatchSlot.objects.filter(ticket_batch__event=self.event).aggregate(
+            remaining=remaining
+        )['remaining'] or 0
+        return batches + slots
+
+    def get_checkout_time(self, durations):
+        """
+        Median of the recent checkout durations. Until someone checks out assume
+        that admitted users keep their token for its whole lifetime.
+        """
+        if not durations:
+            return self.token_ttl
+        return min(median(durations), self.token_ttl)
+
+    def next_batch_size(self):
+        """
+        Admit enough users to keep `admission_batch_size` users arriving per tick
+        at the current checkout time, without admitting more users than there are
+        tickets left for the ones already holding a token.
+        :return: number of users to admit on this tick.
+        """
+        holders, durations = self.queue_service.get_admission_stats()
+        checkout_time = self.get_checkout_time(durations)
+        batch_size = self.event.admission_batch_size
+        tick = self.event.admission_tick_seconds
+
+        max_holders = batch_size * max(math.ceil(checkout_time / tick), 1)
+        remaining = self.get_remaining_tickets()
+        return max(min(batch_size, max_holders - holders, remaining - holders), 0)
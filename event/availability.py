@@ -0,0 +1,128 @@
+import time
+
+from django.db import transaction
+
+from event.redis_client import get_redis
+
+AVAILABILITY_TTL = 60
+LOAD_LOCK_TIMEOUT = 10
+LOAD_WAIT = 2
+POLL_INTERVAL = 0.05
+
+# Sentinel field, so an event without ticket batches is cached too.
+LOADED_FIELD = 'loaded'
+
+# Move the tickets left of a batch, only while the hash is loaded.
+# KEYS: availability  ARGV: ticket batch id, delta
+ADJUST_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# Publish a load only if the hash was not invalidated since the caller read the generation.
+# KEYS: availability, generation  ARGV: generation read by the caller, ttl, field, value, ...
+PUBLISH_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: availability, generation
+INVALIDATE_SCRIPT = """
+redis.call('INCR', KEYS[2])
+return redis.call('DEL', KEYS[1])
+"""
+
+
+class Availability:
+    def __init__(self, event_id, client=None):
+        """
+        Tickets left in every batch of an event, one hash field per batch. Bookings and
+        releases move the fields as they commit, a missing hash is loaded from the database
+        by one request at a time. A change committed while a load runs can be missed or counted
+        twice, the hash expires after AVAILABILITY_TTL seconds so such drift does not outlive it.
+        :param event_id: ID of the event.
+        :param client: Redis client to use, defaults to the shared pooled client.
+        """
+        self.redis = client or get_redis()
+        self.key = f"event{{{event_id}}}:availability"
+        self.generation_key = f"event{{{event_id}}}:availability_generation"
+        self.lock_key = f"event{{{event_id}}}:availability_lock"
+        self.generation = None
+
+        self.adjust_script = self.redis.register_script(ADJUST_SCRIPT)
+        self.publish_script = self.redis.register_script(PUBLISH_SCRIPT)
+        self.invalidate_script = self.redis.register_script(INVALIDATE_SCRIPT)
+
+    def read(self):
+        """
+        :return: {ticket_batch_id: tickets left}, or None if the hash has to be loaded.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.hgetall(self.key)
+        pipeline.get(self.generation_key)
+        fields, generation = pipeline.execute()
+        self.generation = int(generation or 0)
+        if not fields:
+            return None
+        return {int(field): int(value) for field, value in fields.items() if field.isdigit()}
+
+    def publish(self, remaining: dict):
+        """
+        Store what was loaded from the database, unless it changed since read().
+        """
+        if self.generation is None:
+            return
+        pairs = [LOADED_FIELD, 1]
+        for ticket_batch_id, tickets_left in remaining.items():
+            pairs.extend([ticket_batch_id, tickets_left])
+        self.publish_script(keys=[self.key, self.generation_key], args=[self.generation, AVAILABILITY_TTL, *pairs])
+
+    def adjust(self, ticket_batch_id, delta: int):
+        self.adjust_script(keys=[self.key], args=[ticket_batch_id, delta])
+
+    def lock_load(self):
+        """
+        :return: True if this request loads the hash, False if another one already does.
+        """
+        return bool(self.redis.set(self.lock_key, 1, nx=True, ex=LOAD_LOCK_TIMEOUT))
+
+    def unlock_load(self):
+        self.redis.delete(self.lock_key)
+
+    def wait(self):
+        """
+        Wait up to LOAD_WAIT seconds for the load of another request.
+        :return: the loaded availability, or None if it did not finish in time.
+        """
+        deadline = time.monotonic() + LOAD_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            remaining = self.read()
+            if remaining is not None:
+                return remaining
+        return None
+
+    def invalidate(self):
+        self.invalidate_script(keys=[self.key, self.generation_key])
+
+
+def adjust_availability(event_id, ticket_batch_id, delta):
+    """
+    Move the tickets left of a batch by `delta` once the current transaction commits.
+    """
+    transaction.on_commit(lambda: Availability(event_id).adjust(ticket_batch_id, delta))
+
+
+def invalidate_availability(event_id):
+    """
+    Drop the event's availability once the current transaction commits, the next read loads it again.
+    """
+    transaction.on_commit(lambda: Availability(event_id).invalidate())
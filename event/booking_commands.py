@@ -0,0 +1,239 @@
+import json
+import threading
+import uuid
+import zlib
+from collections import defaultdict
+
+from confluent_kafka import Consumer, KafkaError, KafkaException, Producer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+
+from event.availability import adjust_availability
+from event.models import Booking, TicketBatch
+from event.redis_client import get_redis
+
+QUEUED = 'queued'
+REJECTED = 'rejected'
+
+
+class KafkaBookingLog:
+    def __init__(self):
+        """
+        Booking commands on a Kafka topic keyed by ticket batch, so every batch lives on one
+        partition and its commands are applied in order by a single consumer.
+        The producer and the consumer are created on first use.
+        """
+        self.topic = settings.KAFKA_BOOKING_TOPIC
+        self.producer = None
+        self.consumer = None
+
+    def produce(self, key, value):
+        """
+        Publish and wait for the broker's acknowledgement, a booking is only accepted once it is in the log.
+        """
+        if self.producer is None:
+            self.producer = Producer({
+                'bootstrap.servers': settings.KAFKA_BOOTSTRAP_SERVERS,
+                'enable.idempotence': True,
+            })
+        errors = []
+        self.producer.produce(self.topic, key=key, value=value, on_delivery=lambda error, _: errors.append(error))
+        if self.producer.flush(settings.KAFKA_PRODUCE_TIMEOUT) or not errors:
+            raise KafkaException(KafkaError(KafkaError._MSG_TIMED_OUT))
+        if errors[0] is not None:
+            raise KafkaException(errors[0])
+
+    def consume(self, max_messages, timeout):
+        if self.consumer is None:
+            self.consumer = Consumer({
+                'bootstrap.servers': settings.KAFKA_BOOTSTRAP_SERVERS,
+                'group.id': settings.KAFKA_BOOKING_GROUP,
+                'enable.auto.commit': False,
+                'auto.offset.reset': 'earliest',
+            })
+            self.consumer.subscribe([self.topic])
+        values = []
+        for message in self.consumer.consume(max_messages, timeout):
+            if message.error():
+                if message.error().code() == KafkaError._PARTITION_EOF:
+                    continue
+                raise KafkaException(message.error())
+            values.append(message.value())
+        return values
+
+    def commit(self):
+        self.consumer.commit(asynchronous=False)
+
+    def close(self):
+        if self.consumer is not None:
+            self.consumer.close()
+
+
+class InMemoryBookingLog:
+    def __init__(self, partitions=None):
+        """
+        Partitioned log kept in this process, a stand-in for Kafka in tests and local runs.
+        Only producers and consumers in the same process see its commands.
+        """
+        self.partitions = [[] for _ in range(partitions or settings.KAFKA_BOOKING_PARTITIONS)]
+        self.positions = [0] * len(self.partitions)
+        self.committed = [0] * len(self.partitions)
+        self.lock = threading.Lock()
+
+    def produce(self, key, value):
+        with self.lock:
+            self.partitions[zlib.crc32(key.encode()) % len(self.partitions)].append(value)
+
+    def consume(self, max_messages, timeout):
+        values = []
+        with self.lock:
+            for index, partition in enumerate(self.partitions):
+                messages = partition[self.positions[index]:self.positions[index] + max_messages - len(values)]
+                self.positions[index] += len(messages)
+                values.extend(messages)
+        return values
+
+    def commit(self):
+        with self.lock:
+            self.committed = list(self.positions)
+
+    def close(self):
+        pass
+
+
+BOOKING_LOGS = {
+    'kafka': KafkaBookingLog,
+    'memory': InMemoryBookingLog,
+}
+
+_log = None
+
+
+def get_booking_log():
+    """
+    Build the log selected by BOOKING_COMMAND_LOG once per process.
+    """
+    global _log
+    if _log is None:
+        _log = BOOKING_LOGS[settings.BOOKING_COMMAND_LOG]()
+    return _log
+
+
+def get_status_key(reference_code):
+    return f"booking_command:{reference_code}"
+
+
+def set_booking_status(reference_code, user_id, status, detail=None, client=None):
+    (client or get_redis()).set(
+        get_status_key(reference_code),
+        json.dumps({"user": user_id, "status": status, "detail": detail}),
+        ex=settings.BOOKING_STATUS_TTL,
+    )
+
+
+def get_booking_status(reference_code):
+    status = get_redis().get(get_status_key(reference_code))
+    return json.loads(status) if status else None
+
+
+def submit_booking(event, user, ticket_batch, ticket_count, hold_expires_at=None):
+    """
+    Publish a booking command for the consume_bookings command to apply.
+    :return: reference code of the booking it will create.
+    """
+    reference_code = str(uuid.uuid4())
+    set_booking_status(reference_code, user.id, QUEUED)
+    get_booking_log().produce(str(ticket_batch.id), json.dumps({
+        "reference_code": reference_code,
+        "user": user.id,
+        "event": event.id,
+        "ticket_batch": ticket_batch.id,
+        "ticket_count": ticket_count,
+        "hold_expires_at": hold_expires_at and hold_expires_at.isoformat(),
+    }))
+    return reference_code
+
+
+def allocate(ticket_batch, commands):
+    """
+    Allocate tickets to the commands in log order. Commands queued before their event
+    or ticket batch was cancelled are rejected, the cancellation job can not see them.
+    :return: accepted commands, rejected commands with their reason and the tickets taken.
+    """
+    available = ticket_batch.number_of_tickets - ticket_batch.tickets_sold if ticket_batch else 0
+    accepted, rejected, taken = [], [], 0
+    for command in commands:
+        if ticket_batch is None:
+            rejected.append((command, "The ticket batch for this event does not exist."))
+        elif ticket_batch.cancelled_at or ticket_batch.event.cancelled_at:
+            rejected.append((command, "The event or ticket batch is cancelled."))
+        elif available == 0:
+            rejected.append((command, "Ticket batch is sold out."))
+        elif command['ticket_count'] > available:
+            rejected.append((command, "Not enough tickets available for booking."))
+        else:
+            available -= command['ticket_count']
+            taken += command['ticket_count']
+            accepted.append(command)
+    return accepted, rejected, taken
+
+
+def apply_booking_commands(commands):
+    """
+    Apply the booking commands of one poll. The consumer owns the partitions of their ticket
+    batches, so the batch rows are read without a lock and all accepted bookings are inserted
+    with one bulk_create. Commands redelivered after a crash are recognised by their reference code.
+    :return: number of bookings created.
+    """
+    with transaction.atomic():
+        existing = {
+            str(reference_code) for reference_code in Booking.objects.filter(
+                reference_code__in=[command['reference_code'] for command in commands]
+            ).values_list('reference_code', flat=True)
+        }
+        commands_by_batch = defaultdict(list)
+        for command in commands:
+            if command['reference_code'] not in existing:
+                commands_by_batch[command['ticket_batch']].append(command)
+
+        ticket_batches = TicketBatch.objects.select_related('event').in_bulk(list(commands_by_batch))
+        accepted, rejected = [], []
+        for ticket_batch_id, batch_commands in commands_by_batch.items():
+            batch_accepted, batch_rejected, taken = allocate(ticket_batches.get(ticket_batch_id), batch_commands)
+            if taken and not TicketBatch.objects.filter(
+                id=ticket_batch_id, tickets_sold__lte=F('number_of_tickets') - taken
+            ).update(tickets_sold=F('tickets_sold') + taken):
+                # Tickets were sold outside the log since the read, allocate again under a lock.
+                ticket_batch = TicketBatch.objects.select_related('event').select_for_update(of=('self',)).get(
+                    id=ticket_batch_id
+                )
+                batch_accepted, batch_rejected, taken = allocate(ticket_batch, batch_commands)
+                TicketBatch.objects.filter(id=ticket_batch_id).update(tickets_sold=F('tickets_sold') + taken)
+            if taken:
+                adjust_availability(batch_commands[0]['event'], ticket_batch_id, -taken)
+            accepted.extend(batch_accepted)
+            rejected.extend(batch_rejected)
+
+        confirmed_at = now()
+        Booking.objects.bulk_create([
+            Booking(
+                user_id=command['user'],
+                event_id=command['event'],
+                ticket_batch_id=command['ticket_batch'],
+                ticket_count=command['ticket_count'],
+                reference_code=command['reference_code'],
+                hold_expires_at=command['hold_expires_at'] and parse_datetime(command['hold_expires_at']),
+                payment_status=(Booking.BookingStatusChoices.PENDING if command['hold_expires_at']
+                                else Booking.BookingStatusChoices.CONFIRMED),
+                confirmed_at=None if command['hold_expires_at'] else confirmed_at,
+            )
+            for command in accepted
+        ])
+
+    redis = get_redis()
+    for command, detail in rejected:
+        set_booking_status(command['reference_code'], command['user'], REJECTED, detail, client=redis)
+    return len(accepted)
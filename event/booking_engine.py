@@ -0,0 +1,223 @@
+import threading
+from concurrent.futures import Future, TimeoutError
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils.timezone import now
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from event.availability import adjust_availability
+from event.models import Booking, TicketBatch
+
+
+def build_booking(event, user, ticket_batch, ticket_count, hold_expires_at=None):
+    """
+    Unsaved booking, confirmed right away or held until `hold_expires_at`.
+    """
+    booking = Booking(
+        user=user,
+        event=event,
+        ticket_batch=ticket_batch,
+        ticket_count=ticket_count,
+        hold_expires_at=hold_expires_at,
+    )
+    if hold_expires_at:
+        booking.payment_status = Booking.BookingStatusChoices.PENDING
+    else:
+        booking.payment_status = Booking.BookingStatusChoices.CONFIRMED
+        booking.confirmed_at = now()
+    return booking
+
+
+class DirectBookingEngine:
+    """
+    Every booking takes its own transaction and lock of the TicketBatch row.
+    """
+
+    def book(self, event, user, ticket_batch, ticket_count, hold_expires_at=None):
+        with transaction.atomic():
+            ticket_batch = TicketBatch.objects.select_for_update().get(id=ticket_batch.id)
+            if ticket_batch.cancelled_at:
+                raise ValidationError("The event or ticket batch is cancelled.")
+            if ticket_batch.tickets_sold >= ticket_batch.number_of_tickets:
+                raise ValidationError("Ticket batch is sold out.", code='sold_out')
+            if ticket_batch.tickets_sold + ticket_count > ticket_batch.number_of_tickets:
+                raise ValidationError("Not enough tickets available for booking.")
+            ticket_batch.tickets_sold += ticket_count
+            ticket_batch.save(update_fields=['tickets_sold'])
+            booking = build_booking(event, user, ticket_batch, ticket_count, hold_expires_at)
+            booking.save()
+            adjust_availability(event.id, ticket_batch.id, -ticket_count)
+        return booking
+
+
+# Take the tickets and insert the booking in one round trip. The batch row is locked only while
+# the statement runs, if the batch has too few tickets or was cancelled the UPDATE matches nothing
+# and no booking is inserted.
+BOOK_SQL = f"""
+WITH batch AS (
+    UPDATE {TicketBatch._meta.db_table}
+    SET tickets_sold = tickets_sold + %(ticket_count)s
+    WHERE id = %(ticket_batch)s AND event_id = %(event)s AND tickets_sold + %(ticket_count)s <= number_of_tickets
+        AND cancelled_at IS NULL
+    RETURNING id, number_of_tickets, tickets_sold
+)
+INSERT INTO {Booking._meta.db_table}
+    (user_id, event_id, ticket_batch_id, ticket_count, payment_status, confirmed_at, hold_expires_at, reference_code)
+SELECT %(user)s, %(event)s, batch.id, %(ticket_count)s, %(payment_status)s, %(confirmed_at)s, %(hold_expires_at)s,
+    %(reference_code)s
+FROM batch
+RETURNING id, (SELECT number_of_tickets FROM batch), (SELECT tickets_sold FROM batch)
+"""
+
+
+class SingleStatementBookingEngine:
+    """
+    Every booking is a single conditional UPDATE of the TicketBatch row and the INSERT of the booking.
+    """
+
+    def book(self, event, user, ticket_batch, ticket_count, hold_expires_at=None):
+        booking = build_booking(event, user, ticket_batch, ticket_count, hold_expires_at)
+        with connection.cursor() as cursor:
+            cursor.execute(BOOK_SQL, {
+                'ticket_batch': ticket_batch.id,
+                'event': event.id,
+                'user': user.id,
+                'ticket_count': ticket_count,
+                'payment_status': booking.payment_status,
+                'confirmed_at': booking.confirmed_at,
+                'hold_expires_at': hold_expires_at,
+                'reference_code': booking.reference_code,
+            })
+            row = cursor.fetchone()
+        if row is None:
+            # Only a failed booking pays for a second query to tell why.
+            ticket_batch = TicketBatch.objects.get(id=ticket_batch.id, event=event)
+            if ticket_batch.cancelled_at:
+                raise ValidationError("The event or ticket batch is cancelled.")
+            if ticket_batch.tickets_sold >= ticket_batch.number_of_tickets:
+                raise ValidationError("Ticket batch is sold out.", code='sold_out')
+            raise ValidationError("Not enough tickets available for booking.")
+        booking.id, ticket_batch.number_of_tickets, ticket_batch.tickets_sold = row
+        adjust_availability(event.id, ticket_batch.id, -ticket_count)
+        return booking
+
+
+class BookingTimeout(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The booking is taking too long, please check your bookings before trying again."
+    default_code = 'booking_timeout'
+
+
+class BookingRequest:
+    def __init__(self, event, user, ticket_count, hold_expires_at):
+        self.event = event
+        self.user = user
+        self.ticket_count = ticket_count
+        self.hold_expires_at = hold_expires_at
+        self.result = Future()
+
+
+class BookingGroup:
+    def __init__(self):
+        self.requests = []
+        self.full = threading.Event()
+
+
+class GroupCommitBookingEngine:
+    def __init__(self, window=None, max_group_size=None, timeout=None):
+        """
+        Coalesce concurrent bookings of a ticket batch in this process. The first request of a
+        batch becomes the leader, collects the requests arriving within `window` seconds, then
+        locks the batch row once, allocates tickets in arrival order, inserts all bookings with
+        one bulk_create and hands every caller its own booking or error.
+        Requests only meet each other when the server runs views in several threads.
+        :param window: Seconds the leader waits for more requests.
+        :param max_group_size: The leader stops waiting once this many requests are collected.
+        :param timeout: Seconds a request waits for its group's commit before giving up with BookingTimeout,
+            the commit may still go through after that.
+        """
+        self.window = settings.BOOKING_GROUP_COMMIT_WINDOW if window is None else window
+        self.max_group_size = max_group_size or settings.BOOKING_GROUP_COMMIT_MAX_SIZE
+        self.timeout = timeout or settings.BOOKING_GROUP_COMMIT_TIMEOUT
+        self.lock = threading.Lock()
+        self.groups = {}
+
+    def book(self, event, user, ticket_batch, ticket_count, hold_expires_at=None):
+        request = BookingRequest(event, user, ticket_count, hold_expires_at)
+        with self.lock:
+            group = self.groups.get(ticket_batch.id)
+            is_leader = group is None
+            if is_leader:
+                group = self.groups[ticket_batch.id] = BookingGroup()
+            group.requests.append(request)
+            if len(group.requests) >= self.max_group_size:
+                del self.groups[ticket_batch.id]
+                group.full.set()
+
+        if is_leader:
+            group.full.wait(self.window)
+            with self.lock:
+                if self.groups.get(ticket_batch.id) is group:
+                    del self.groups[ticket_batch.id]
+            try:
+                self.commit(ticket_batch.id, group.requests)
+            except BaseException as e:
+                for pending in group.requests:
+                    if not pending.result.done():
+                        pending.result.set_exception(e)
+                raise
+        try:
+            return request.result.result(self.timeout)
+        except TimeoutError:
+            raise BookingTimeout()
+
+    def commit(self, ticket_batch_id, requests):
+        accepted, rejected = [], []
+        with transaction.atomic():
+            ticket_batch = TicketBatch.objects.select_for_update().get(id=ticket_batch_id)
+            available = ticket_batch.number_of_tickets - ticket_batch.tickets_sold
+            for request in requests:
+                if ticket_batch.cancelled_at:
+                    rejected.append((request, ValidationError("The event or ticket batch is cancelled.")))
+                elif available == 0:
+                    rejected.append((request, ValidationError("Ticket batch is sold out.", code='sold_out')))
+                elif request.ticket_count > available:
+                    rejected.append((request, ValidationError("Not enough tickets available for booking.")))
+                else:
+                    available -= request.ticket_count
+                    accepted.append(request)
+            ticket_batch.tickets_sold = ticket_batch.number_of_tickets - available
+            bookings = Booking.objects.bulk_create([
+                build_booking(request.event, request.user, ticket_batch, request.ticket_count, request.hold_expires_at)
+                for request in accepted
+            ])
+            taken = sum(request.ticket_count for request in accepted)
+            TicketBatch.objects.filter(id=ticket_batch_id).update(tickets_sold=F('tickets_sold') + taken)
+            adjust_availability(ticket_batch.event_id, ticket_batch_id, -taken)
+        # Results are handed out only after the commit, so no caller sees a booking that could still roll back.
+        for request, booking in zip(accepted, bookings):
+            request.result.set_result(booking)
+        for request, error in rejected:
+            request.result.set_exception(error)
+
+
+BOOKING_ENGINES = {
+    'direct': DirectBookingEngine,
+    'group_commit': GroupCommitBookingEngine,
+    'single_statement': SingleStatementBookingEngine,
+}
+
+_engine = None
+
+
+def get_booking_engine():
+    """
+    Build the engine selected by BOOKING_ENGINE once per process, it books database inventory batches.
+    """
+    global _engine
+    if _engine is None:
+        _engine = BOOKING_ENGINES[settings.BOOKING_ENGINE]()
+    return _engine
@@ -0,0 +1,74 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils.timezone import now
+
+from event.inventory import inventory_locks, release_tickets
+from event.models import Booking, CancellationJob, TicketBatch
+
+
+def get_job_bookings(job):
+    bookings = Booking.objects.filter(event_id=job.event_id)
+    if job.ticket_batch_id:
+        bookings = bookings.filter(ticket_batch_id=job.ticket_batch_id)
+    return bookings
+
+
+def start_cancellation(event, user, ticket_batch=None):
+    """
+    Stop sales of the event or ticket batch and create the job that cancels its bookings.
+    Cancelling an event also marks its ticket batches, so every booking path only has to check the batch
+    row it locks or updates, and bookings waiting on those rows see the cancellation once they get them.
+    """
+    with transaction.atomic():
+        if ticket_batch:
+            ticket_batch.cancelled_at = now()
+            ticket_batch.save(update_fields=['cancelled_at', 'updated_at'])
+        else:
+            TicketBatch.objects.filter(event=event, cancelled_at__isnull=True).update(
+                cancelled_at=now(), updated_at=now(),
+            )
+            event.cancelled_at = now()
+            event.is_active = False
+            event.active_queue = False
+            event.save(update_fields=['cancelled_at', 'is_active', 'active_queue', 'updated_at'])
+        job = CancellationJob(event=event, ticket_batch=ticket_batch, requested_by=user)
+        job.total_bookings = get_job_bookings(job).exclude(payment_status=Booking.BookingStatusChoices.CANCELLED).count()
+        job.save()
+    return job
+
+
+def cancel_next_chunk(job_id, chunk_size):
+    """
+    Cancel the next chunk of a job's bookings, release their tickets with one update per ticket batch
+    and move the cursor, all in one transaction, so an interrupted job never cancels a booking twice.
+    :return: False once the job has no bookings left.
+    """
+    with inventory_locks() as locks, transaction.atomic():
+        job = CancellationJob.objects.select_for_update().get(id=job_id)
+        chunk = list(
+            get_job_bookings(job).select_for_update().filter(id__gt=job.last_booking_id).order_by('id')
+            .values_list('id', 'ticket_batch_id', 'ticket_count', 'payment_status')[:chunk_size]
+        )
+        if not chunk:
+            job.status = CancellationJob.StatusChoices.COMPLETED
+            job.finished_at = now()
+            job.save(update_fields=['status', 'finished_at', 'updated_at'])
+            return False
+
+        cancelled = [row for row in chunk if row[3] != Booking.BookingStatusChoices.CANCELLED]
+        Booking.objects.filter(id__in=[booking_id for booking_id, _, _, _ in cancelled]).update(
+            payment_status=Booking.BookingStatusChoices.CANCELLED,
+            cancelled_at=now(),
+            hold_expires_at=None,
+        )
+        released = defaultdict(int)
+        for _, ticket_batch_id, ticket_count, _ in cancelled:
+            released[ticket_batch_id] += ticket_count
+        for ticket_batch in TicketBatch.objects.filter(id__in=released).select_related('event').order_by('id'):
+            release_tickets(ticket_batch, released[ticket_batch.id], locks)
+
+        job.last_booking_id = chunk[-1][0]
+        job.cancelled_bookings += len(cancelled)
+        job.save(update_fields=['last_booking_id', 'cancelled_bookings', 'updated_at'])
+    return True
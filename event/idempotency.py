@@ -0,0 +1,92 @@
+import functools
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from redis.exceptions import LockError
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from event.redis_client import get_redis
+
+IN_FLIGHT_TTL = 30
+WAIT_TIMEOUT = 10
+POLL_INTERVAL = 0.05
+
+
+def get_idempotency_key(request, key):
+    """
+    Keys are scoped to the user and the endpoint, so clients can not replay each other's responses.
+    """
+    scope = f"{request.user.id}:{request.method}:{request.path}:{key}"
+    return f"idempotency:{hashlib.sha256(scope.encode()).hexdigest()}"
+
+
+def get_fingerprint(request):
+    return hashlib.sha256(json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+
+def replay(stored, fingerprint):
+    stored = json.loads(stored)
+    if stored['fingerprint'] != fingerprint:
+        return Response({"detail": "This Idempotency-Key was used with a different request."},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    response = Response(stored['data'], status=stored['status'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Honour an `Idempotency-Key` header on a viewset action. The first response is stored in
+    Redis for IDEMPOTENCY_KEY_TTL seconds and replayed to retries with the same key, requests
+    arriving while the first one runs wait for its result instead of doing the work again.
+    Server errors are not stored, so the next retry runs the action again.
+    """
+    @functools.wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(self, request, *args, **kwargs)
+
+        redis = get_redis()
+        response_key = get_idempotency_key(request, key)
+        # The lock holds a random token, so a request that outlived IN_FLIGHT_TTL can not release
+        # the lock of the request that took it over.
+        lock = redis.lock(f"{response_key}:lock", timeout=IN_FLIGHT_TTL)
+        fingerprint = get_fingerprint(request)
+
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while not lock.acquire(blocking=False):
+            stored = redis.get(response_key)
+            if stored:
+                return replay(stored, fingerprint)
+            if time.monotonic() > deadline:
+                return Response({"detail": "A request with this Idempotency-Key is still in progress."},
+                                status=status.HTTP_409_CONFLICT)
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            stored = redis.get(response_key)
+            if stored:
+                return replay(stored, fingerprint)
+            try:
+                response = view(self, request, *args, **kwargs)
+            except APIException as exc:
+                response = self.handle_exception(exc)
+            if response.status_code < 500:
+                redis.set(response_key, json.dumps(
+                    {"fingerprint": fingerprint, "status": response.status_code, "data": response.data},
+                    cls=DjangoJSONEncoder,
+                ), ex=settings.IDEMPOTENCY_KEY_TTL)
+            return response
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+
+    return wrapper
@@ -0,0 +1,506 @@
+import json
+import random
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+from redis.exceptions import LockError
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from event.availability import Availability, adjust_availability, invalidate_availability
+from event.booking_engine import build_booking
+from event.models import Booking, Event, TicketBatch, TicketBatchSlot
+from event.redis_client import get_redis
+from event.stock_cache import invalidate_stock
+
+FLUSH_BATCH_SIZE = 500
+FLUSH_ROUNDS = 10
+FLUSH_LOCK_TIMEOUT = 30
+FLUSH_LOCK_WAIT = 5
+
+# Check-and-decrement of the remaining tickets. A successful reservation is queued for
+# write-behind in the same step, so a booking is never counted without being persisted.
+# KEYS: remaining, pending  ARGV: ticket count, booking as JSON
+RESERVE_SCRIPT = """
+local remaining = redis.call('GET', KEYS[1])
+if not remaining then
+    return -1
+end
+remaining = tonumber(remaining)
+if remaining <= 0 then
+    return -2
+end
+if remaining < tonumber(ARGV[1]) then
+    return -3
+end
+redis.call('RPUSH', KEYS[2], ARGV[2])
+return redis.call('DECRBY', KEYS[1], ARGV[1])
+"""
+
+# Sets the remaining tickets to what the database has left minus the bookings still waiting
+# to be written. With `only if missing` an existing counter is left alone.
+# KEYS: remaining, pending  ARGV: tickets left in the database, only if missing
+SYNC_SCRIPT = """
+if ARGV[2] == '1' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return tonumber(redis.call('GET', KEYS[1]))
+end
+local remaining = tonumber(ARGV[1])
+for _, entry in ipairs(redis.call('LRANGE', KEYS[2], 0, -1)) do
+    remaining = remaining - tonumber(cjson.decode(entry)['ticket_count'])
+end
+redis.call('SET', KEYS[1], remaining)
+return remaining
+"""
+
+# Give tickets back to a counter that exists, a missing counter is seeded from the database later.
+# KEYS: remaining  ARGV: ticket count
+RELEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+
+class InventoryBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The ticket batch is busy, please try again."
+    default_code = 'inventory_busy'
+
+
+class RedisInventory:
+    def __init__(self, ticket_batch_id, client=None):
+        """
+        Remaining tickets of a TicketBatch with inventory_mode `redis`, and the bookings
+        reserved against them that are not persisted to the database yet.
+        :param ticket_batch_id: ID of the ticket batch.
+        :param client: Redis client to use, defaults to the shared pooled client.
+        """
+        self.redis = client or get_redis()
+        self.ticket_batch_id = ticket_batch_id
+        self.remaining_key = f"ticket_batch{{{ticket_batch_id}}}:remaining"
+        self.pending_key = f"ticket_batch{{{ticket_batch_id}}}:pending"
+        self.lock_key = f"ticket_batch{{{ticket_batch_id}}}:lock"
+
+        self.reserve_script = self.redis.register_script(RESERVE_SCRIPT)
+        self.sync_script = self.redis.register_script(SYNC_SCRIPT)
+        self.release_script = self.redis.register_script(RELEASE_SCRIPT)
+
+    def reserve(self, ticket_count: int, booking: dict) -> int:
+        """
+        Take `ticket_count` tickets and queue the booking for write-behind.
+        :return: tickets remaining after the reservation.
+        """
+        booking = json.dumps(booking)
+        remaining = self.reserve_script(keys=[self.remaining_key, self.pending_key], args=[ticket_count, booking])
+        if remaining == -1:
+            # Only the first request of a burst seeds the counter, the others find it seeded once they get the lock.
+            try:
+                with self.get_lock():
+                    remaining = self.reserve_script(
+                        keys=[self.remaining_key, self.pending_key], args=[ticket_count, booking],
+                    )
+                    if remaining == -1:
+                        seed_ticket_batch(self, only_if_missing=True)
+                        remaining = self.reserve_script(
+                            keys=[self.remaining_key, self.pending_key], args=[ticket_count, booking],
+                        )
+            except LockError:
+                raise InventoryBusy()
+        if remaining == -1:
+            raise InventoryBusy()
+        if remaining == -2:
+            raise ValidationError("Ticket batch is sold out.", code='sold_out')
+        if remaining == -3:
+            raise ValidationError("Not enough tickets available for booking.")
+        return remaining
+
+    def sync(self, tickets_left: int, only_if_missing=False) -> int:
+        return self.sync_script(
+            keys=[self.remaining_key, self.pending_key], args=[tickets_left, int(only_if_missing)],
+        )
+
+    def release(self, ticket_count: int):
+        return self.release_script(keys=[self.remaining_key], args=[ticket_count])
+
+    def get_pending(self, limit: int):
+        return [json.loads(entry) for entry in self.redis.lrange(self.pending_key, 0, limit - 1)]
+
+    def trim_pending(self, count: int):
+        self.redis.ltrim(self.pending_key, count, -1)
+
+    def get_lock(self):
+        """
+        Held while pending bookings are written to the database or the counter is reconciled,
+        so both never see a booking that is persisted and still pending at the same time.
+        """
+        return self.redis.lock(self.lock_key, timeout=FLUSH_LOCK_TIMEOUT, blocking_timeout=FLUSH_LOCK_WAIT)
+
+
+def reserve_booking(event, user, ticket_batch, ticket_count, hold_expires_at=None):
+    """
+    Book tickets of a redis inventory batch, or hold them until `hold_expires_at`. The returned
+    booking is not saved yet, flush_ticket_batch writes it to the database shortly after.
+    :return: the booking and the tickets left in the batch.
+    """
+    booking = build_booking(event, user, ticket_batch, ticket_count, hold_expires_at)
+    remaining = RedisInventory(ticket_batch.id).reserve(ticket_count, {
+        "user": user.id,
+        "event": event.id,
+        "ticket_count": ticket_count,
+        "payment_status": booking.payment_status,
+        "confirmed_at": booking.confirmed_at and booking.confirmed_at.isoformat(),
+        "hold_expires_at": hold_expires_at and hold_expires_at.isoformat(),
+        "reference_code": str(booking.reference_code),
+    })
+    adjust_availability(event.id, ticket_batch.id, -ticket_count)
+    return booking, remaining
+
+
+def persist_bookings(ticket_batch_id, entries):
+    """
+    Write pending bookings and their tickets_sold in one transaction. Bookings that are
+    already stored, because a previous flush died before trimming the list, are skipped.
+    Bookings reserved before their event or ticket batch was cancelled are stored as cancelled
+    and sell no tickets, the cancellation job may have finished before they were written.
+    """
+    with transaction.atomic():
+        ticket_batch = TicketBatch.objects.select_related('event').get(id=ticket_batch_id)
+        cancelled_at = ticket_batch.cancelled_at or ticket_batch.event.cancelled_at
+        existing = {
+            str(reference_code) for reference_code in Booking.objects.filter(
+                reference_code__in=[entry['reference_code'] for entry in entries]
+            ).values_list('reference_code', flat=True)
+        }
+        bookings = [
+            Booking(
+                user_id=entry['user'],
+                event_id=entry['event'],
+                ticket_batch_id=ticket_batch_id,
+                ticket_count=entry['ticket_count'],
+                payment_status=entry['payment_status'],
+                confirmed_at=entry['confirmed_at'] and parse_datetime(entry['confirmed_at']),
+                hold_expires_at=entry.get('hold_expires_at') and parse_datetime(entry['hold_expires_at']),
+                reference_code=entry['reference_code'],
+            )
+            for entry in entries if entry['reference_code'] not in existing
+        ]
+        if cancelled_at:
+            for booking in bookings:
+                booking.payment_status = Booking.BookingStatusChoices.CANCELLED
+                booking.cancelled_at = now()
+                booking.hold_expires_at = None
+        Booking.objects.bulk_create(bookings)
+        if not cancelled_at:
+            TicketBatch.objects.filter(id=ticket_batch_id).update(
+                tickets_sold=F('tickets_sold') + sum(booking.ticket_count for booking in bookings)
+            )
+    return len(bookings)
+
+
+def flush_ticket_batch(ticket_batch_id):
+    """
+    Persist the pending bookings of a batch in chunks of FLUSH_BATCH_SIZE.
+    :return: number of bookings written, None if another worker is flushing the batch.
+    """
+    inventory = RedisInventory(ticket_batch_id)
+    lock = inventory.get_lock()
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        flushed = 0
+        for _ in range(FLUSH_ROUNDS):
+            entries = inventory.get_pending(FLUSH_BATCH_SIZE)
+            if not entries:
+                break
+            flushed += persist_bookings(ticket_batch_id, entries)
+            inventory.trim_pending(len(entries))
+        return flushed
+    finally:
+        lock.release()
+
+
+def seed_ticket_batch(inventory, only_if_missing):
+    """
+    Recount tickets_sold from the stored bookings and reset the Redis counter to what is
+    left after them and the pending bookings. The caller holds the inventory lock.
+    """
+    with transaction.atomic():
+        invalidate_stock(inventory.ticket_batch_id)
+        ticket_batch = TicketBatch.objects.select_for_update().get(id=inventory.ticket_batch_id)
+        invalidate_availability(ticket_batch.event_id)
+        tickets_sold = ticket_batch.bookings.exclude(
+            payment_status=Booking.BookingStatusChoices.CANCELLED
+        ).aggregate(total=Sum('ticket_count'))['total'] or 0
+        if tickets_sold != ticket_batch.tickets_sold:
+            TicketBatch.objects.filter(id=ticket_batch.id).update(tickets_sold=tickets_sold)
+    return inventory.sync(ticket_batch.number_of_tickets - tickets_sold, only_if_missing)
+
+
+def reconcile_ticket_batch(ticket_batch_id, only_if_missing=False):
+    """
+    Reseed the Redis counter of a batch under its lock. Fixes drift after a crash of Redis or a worker.
+    """
+    inventory = RedisInventory(ticket_batch_id)
+    with inventory.get_lock():
+        return seed_ticket_batch(inventory, only_if_missing)
+
+
+def release_redis_tickets(ticket_batch_id, ticket_count, locks):
+    """
+    Give tickets back to the Redis counter once the surrounding transaction commits. The inventory
+    lock is taken before the database update and held until the counter is raised, so a reconcile
+    can never count the freed tickets in between and have them added a second time.
+    The lock is added to `locks`, see inventory_locks.
+    """
+    inventory = RedisInventory(ticket_batch_id)
+    lock = inventory.get_lock()
+    if not lock.acquire():
+        raise InventoryBusy()
+    locks.append(lock)
+
+    def release():
+        try:
+            inventory.release(ticket_count)
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                # The transaction outlived the lock.
+                pass
+
+    transaction.on_commit(release)
+
+
+@contextmanager
+def inventory_locks():
+    """
+    Collect the inventory locks taken by release_redis_tickets. They are released on commit once
+    the counters are raised, if the transaction fails they are released right away instead of
+    blocking the batches until they expire. Enter it before the transaction:
+    `with inventory_locks() as locks, transaction.atomic():`.
+    """
+    locks = []
+    try:
+        yield locks
+    except BaseException:
+        for lock in locks:
+            try:
+                lock.release()
+            except LockError:
+                pass
+        raise
+
+
+def distribute_slots(ticket_batch):
+    """
+    Create the slots of a sharded batch, or spread a changed number_of_tickets over them.
+    The unsold tickets are split evenly, every slot keeps the tickets it has sold.
+    """
+    with transaction.atomic():
+        slots = list(TicketBatchSlot.objects.select_for_update().filter(ticket_batch=ticket_batch).order_by('index'))
+        if not slots:
+            slots = TicketBatchSlot.objects.bulk_create(
+                [TicketBatchSlot(ticket_batch=ticket_batch, index=index) for index in range(ticket_batch.inventory_slots)]
+            )
+        available = ticket_batch.number_of_tickets - sum(slot.tickets_sold for slot in slots)
+        if available < 0:
+            raise ValidationError("Number of tickets can not be lower than the tickets already sold.")
+        share, extra = divmod(available, len(slots))
+        for slot in slots:
+            slot.number_of_tickets = slot.tickets_sold + share + (slot.index < extra)
+        TicketBatchSlot.objects.bulk_update(slots, ['number_of_tickets'])
+
+
+def take_slot_tickets(ticket_batch, ticket_count):
+    """
+    Sell `ticket_count` tickets from a random slot that has enough of them left. The
+    conditional UPDATE locks only that slot until the surrounding transaction commits,
+    if a concurrent booking emptied it first the next candidate is tried.
+    When no single slot has enough left, the booking is split over the slots in index order.
+    Every UPDATE also requires the batch to be uncancelled, so a booking can not take slots after
+    the cancellation committed.
+    """
+    candidates = list(
+        TicketBatchSlot.objects.filter(ticket_batch=ticket_batch, tickets_sold__lt=F('number_of_tickets'))
+        .values_list('id', F('number_of_tickets') - F('tickets_sold'))
+    )
+    if not candidates:
+        raise ValidationError("Ticket batch is sold out.", code='sold_out')
+    slot_ids = [slot_id for slot_id, remaining in candidates if remaining >= ticket_count]
+    random.shuffle(slot_ids)
+    for slot_id in slot_ids:
+        taken = TicketBatchSlot.objects.filter(
+            id=slot_id, tickets_sold__lte=F('number_of_tickets') - ticket_count,
+            ticket_batch__cancelled_at__isnull=True,
+        ).update(tickets_sold=F('tickets_sold') + ticket_count)
+        if taken:
+            adjust_availability(ticket_batch.event_id, ticket_batch.id, -ticket_count)
+            return
+    take_split_slot_tickets(ticket_batch, ticket_count)
+
+
+def take_split_slot_tickets(ticket_batch, ticket_count):
+    """
+    Sell `ticket_count` tickets from as many slots as needed, filled in index order. Only happens
+    near sell-out, the slots with tickets left are locked in index order so splits never deadlock.
+    """
+    if TicketBatch.objects.filter(id=ticket_batch.id, cancelled_at__isnull=False).exists():
+        raise ValidationError("The event or ticket batch is cancelled.")
+    slots = list(
+        TicketBatchSlot.objects.select_for_update().filter(
+            ticket_batch=ticket_batch, tickets_sold__lt=F('number_of_tickets')
+        ).order_by('index')
+    )
+    if not slots:
+        raise ValidationError("Ticket batch is sold out.", code='sold_out')
+    if sum(slot.number_of_tickets - slot.tickets_sold for slot in slots) < ticket_count:
+        raise ValidationError("Not enough tickets available for booking.")
+    needed = ticket_count
+    taken_slots = []
+    for slot in slots:
+        count = min(slot.number_of_tickets - slot.tickets_sold, needed)
+        slot.tickets_sold += count
+        taken_slots.append(slot)
+        needed -= count
+        if not needed:
+            break
+    TicketBatchSlot.objects.bulk_update(taken_slots, ['tickets_sold'])
+    adjust_availability(ticket_batch.event_id, ticket_batch.id, -ticket_count)
+
+
+def release_tickets(ticket_batch, ticket_count, locks):
+    """
+    Give tickets of cancelled or expired bookings back to their batch, whatever its inventory mode.
+    Must be called inside the transaction that cancels the bookings, `locks` comes from inventory_locks.
+    """
+    invalidate_stock(ticket_batch.id)
+    if ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.REDIS:
+        release_redis_tickets(ticket_batch.id, ticket_count, locks)
+    # Cancelled batches stay at no tickets left, their freed tickets are not for sale.
+    if not (ticket_batch.cancelled_at or ticket_batch.event.cancelled_at):
+        adjust_availability(ticket_batch.event_id, ticket_batch.id, ticket_count)
+    if ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.SHARDED:
+        slots = TicketBatchSlot.objects.filter(ticket_batch=ticket_batch, tickets_sold__gt=0).order_by('index')
+        for slot_id, tickets_sold in slots.values_list('id', 'tickets_sold'):
+            count = min(tickets_sold, ticket_count)
+            ticket_count -= TicketBatchSlot.objects.filter(id=slot_id, tickets_sold__gte=count).update(
+                tickets_sold=F('tickets_sold') - count
+            ) * count
+            if not ticket_count:
+                break
+        return
+    TicketBatch.objects.filter(id=ticket_batch.id).update(tickets_sold=F('tickets_sold') - ticket_count)
+
+
+def release_expired_holds(limit):
+    """
+    Cancel up to `limit` bookings whose hold has expired and release their tickets
+    with one update per ticket batch, batches are locked in id order.
+    :return: number of released holds.
+    """
+    with inventory_locks() as locks, transaction.atomic():
+        expired = list(
+            Booking.objects.select_for_update(skip_locked=True).filter(
+                payment_status=Booking.BookingStatusChoices.PENDING,
+                hold_expires_at__lte=now(),
+            ).values_list('id', 'ticket_batch_id', 'ticket_count')[:limit]
+        )
+        if not expired:
+            return 0
+        Booking.objects.filter(id__in=[booking_id for booking_id, _, _ in expired]).update(
+            payment_status=Booking.BookingStatusChoices.CANCELLED,
+            cancelled_at=now(),
+            hold_expires_at=None,
+        )
+        released = defaultdict(int)
+        for _, ticket_batch_id, ticket_count in expired:
+            released[ticket_batch_id] += ticket_count
+        for ticket_batch in TicketBatch.objects.filter(id__in=released).select_related('event').order_by('id'):
+            release_tickets(ticket_batch, released[ticket_batch.id], locks)
+    return len(expired)
+
+
+def take_cart_tickets(items):
+    """
+    Sell the tickets of every cart line inside the surrounding transaction. Database batch rows are
+    locked in id order and sharded batches take their slots afterwards in the same order, so
+    concurrent carts can never wait on each other in a cycle.
+    """
+    counts = {item['ticket_batch'].id: item['ticket_count'] for item in items}
+    ticket_batches = list(
+        TicketBatch.objects.select_for_update().filter(id__in=counts).exclude(
+            inventory_mode=TicketBatch.InventoryModeChoices.SHARDED
+        ).order_by('id')
+    )
+    for ticket_batch in ticket_batches:
+        if ticket_batch.cancelled_at:
+            raise ValidationError(f"Ticket batch {ticket_batch.id} is cancelled.")
+        if ticket_batch.tickets_sold == ticket_batch.number_of_tickets:
+            raise ValidationError(f"Ticket batch {ticket_batch.id} is sold out.", code='sold_out')
+        if ticket_batch.tickets_sold + counts[ticket_batch.id] > ticket_batch.number_of_tickets:
+            raise ValidationError(f"Not enough tickets available in ticket batch {ticket_batch.id}.")
+        ticket_batch.tickets_sold += counts[ticket_batch.id]
+        adjust_availability(ticket_batch.event_id, ticket_batch.id, -counts[ticket_batch.id])
+    TicketBatch.objects.bulk_update(ticket_batches, ['tickets_sold'])
+
+    for item in sorted(items, key=lambda item: item['ticket_batch'].id):
+        if item['ticket_batch'].inventory_mode == TicketBatch.InventoryModeChoices.SHARDED:
+            take_slot_tickets(item['ticket_batch'], item['ticket_count'])
+
+
+def get_event_availability(event_id):
+    """
+    Tickets left in every batch of the event, read from Redis. Only a miss reads the database, and only
+    one request at a time, batches of a cancelled event or cancelled batches have no tickets left.
+    :return: {ticket_batch_id: tickets left}, or None if the event does not exist.
+    """
+    availability = Availability(event_id)
+    remaining = availability.read()
+    if remaining is not None:
+        return remaining
+    if not availability.lock_load():
+        remaining = availability.wait()
+        if remaining is None:
+            raise InventoryBusy("The availability of this event is being loaded, please try again.")
+        return remaining
+    try:
+        return load_event_availability(event_id, availability)
+    finally:
+        availability.unlock_load()
+
+
+def load_event_availability(event_id, availability):
+    event = Event.objects.filter(id=event_id).values('cancelled_at').first()
+    if event is None:
+        return None
+    ticket_batches = list(
+        TicketBatch.objects.filter(event_id=event_id).annotate(
+            slots_left=Sum(F('slots__number_of_tickets') - F('slots__tickets_sold'))
+        ).values_list('id', 'inventory_mode', 'number_of_tickets', 'tickets_sold', 'cancelled_at', 'slots_left')
+    )
+    redis_batches = [
+        ticket_batch_id for ticket_batch_id, inventory_mode, *_ in ticket_batches
+        if inventory_mode == TicketBatch.InventoryModeChoices.REDIS
+    ]
+    # Redis batches sell from their counter, the database lags behind it until the next flush.
+    counters = dict(zip(redis_batches, get_redis().mget(
+        [RedisInventory(ticket_batch_id).remaining_key for ticket_batch_id in redis_batches]
+    ))) if redis_batches else {}
+
+    remaining = {}
+    for ticket_batch_id, inventory_mode, number_of_tickets, tickets_sold, cancelled_at, slots_left in ticket_batches:
+        if event['cancelled_at'] or cancelled_at:
+            remaining[ticket_batch_id] = 0
+        elif inventory_mode == TicketBatch.InventoryModeChoices.SHARDED:
+            remaining[ticket_batch_id] = slots_left or 0
+        elif counters.get(ticket_batch_id) is not None:
+            remaining[ticket_batch_id] = int(counters[ticket_batch_id])
+        else:
+            remaining[ticket_batch_id] = number_of_tickets - tickets_sold
+    availability.publish(remaining)
+    return remaining
@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from authentication.models import User
+from event.booking_engine import BOOKING_ENGINES, GroupCommitBookingEngine
+from event.models import Category, Event, TicketBatch
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the booking engines: concurrent threads book one ticket batch, "
+            "then report bookings/sec and p50/p99 latency for every engine.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engines', nargs='+', choices=list(BOOKING_ENGINES), default=list(BOOKING_ENGINES))
+        parser.add_argument('--threads', type=int, default=32, help="Concurrent booking threads.")
+        parser.add_argument('--bookings', type=int, default=2000, help="Bookings per engine, split over the threads.")
+        parser.add_argument('--ticket-count', type=int, default=1, help="Tickets per booking.")
+        parser.add_argument('--window', type=float, help="Group commit window in seconds.")
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+
+    def get_engine(self, name, window):
+        if name == 'group_commit':
+            return GroupCommitBookingEngine(window=window)
+        return BOOKING_ENGINES[name]()
+
+    def run_engine(self, engine, options):
+        suffix = uuid.uuid4().hex
+        host = User.objects.create_user(email=f"benchmark-{suffix}@example.com")
+        category = Category.objects.create(name=f"benchmark-{suffix}")
+        try:
+            event = Event.objects.create(
+                category=category, host=host, name="Booking benchmark", start_date=timezone.now(), location="benchmark",
+            )
+            ticket_batch = TicketBatch.objects.create(
+                event=event, number_of_tickets=options['bookings'] * options['ticket_count'],
+            )
+            latencies = []
+            rejected = []
+            failed = []
+
+            def worker(count):
+                try:
+                    for _ in range(count):
+                        started = time.perf_counter()
+                        try:
+                            engine.book(event, host, ticket_batch, options['ticket_count'])
+                        except ValidationError:
+                            rejected.append(1)
+                        except Exception as e:
+                            failed.append(repr(e))
+                        latencies.append(time.perf_counter() - started)
+                finally:
+                    connection.close()
+
+            share, extra = divmod(options['bookings'], options['threads'])
+            threads = [
+                threading.Thread(target=worker, args=(share + (index < extra),)) for index in range(options['threads'])
+            ]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            ticket_batch.refresh_from_db()
+            booked = ticket_batch.bookings.count()
+            latencies.sort()
+            return {
+                "bookings": booked,
+                "rejected": len(rejected),
+                "failed": len(failed),
+                "elapsed_sec": round(elapsed, 3),
+                "bookings_per_sec": round(booked / elapsed, 1),
+                "p50_ms": round(latencies[int(len(latencies) * 0.50)] * 1000, 3),
+                "p99_ms": round(latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000, 3),
+                "consistent": ticket_batch.tickets_sold == booked * options['ticket_count'],
+            }
+        finally:
+            host.delete()
+            category.delete()
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['bookings'] < 1 or options['ticket_count'] < 1:
+            raise CommandError("--threads, --bookings and --ticket-count must be positive.")
+
+        results = {
+            "created_at": timezone.now().isoformat(),
+            "config": {key: options[key] for key in ('threads', 'bookings', 'ticket_count', 'window')},
+            "engines": {
+                name: self.run_engine(self.get_engine(name, options['window']), options) for name in options['engines']
+            },
+        }
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        self.stdout.write(output)
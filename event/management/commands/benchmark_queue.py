@@ -0,0 +1,164 @@
+import json
+import random
+import time
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from event.queue_service import QueueService
+
+
+class ByteCounter:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+
+
+def get_reply_size(reply):
+    """
+    Size of a parsed reply encoded back to RESP, the parser does not expose the raw bytes.
+    """
+    if reply is None:
+        return len(b'$-1\r\n')
+    if isinstance(reply, int):
+        return len(f':{reply}\r\n')
+    if isinstance(reply, str):
+        reply = reply.encode()
+    if isinstance(reply, bytes):
+        return len(f'${len(reply)}\r\n') + len(reply) + 2
+    if isinstance(reply, (list, tuple)):
+        return len(f'*{len(reply)}\r\n') + sum(get_reply_size(item) for item in reply)
+    return len(f'-{reply}\r\n')
+
+
+def count_bytes(client, counter):
+    """
+    Swap the client's connection class for one that counts the bytes written and read.
+    Must be called before the client opens its first connection.
+    """
+    base = client.connection_pool.connection_class
+
+    class CountingConnection(base):
+        def send_packed_command(self, command, check_health=True):
+            chunks = [command] if isinstance(command, (bytes, str)) else command
+            counter.sent += sum(len(chunk) for chunk in chunks)
+            return super().send_packed_command(command, check_health=check_health)
+
+        def read_response(self, *args, **kwargs):
+            response = super().read_response(*args, **kwargs)
+            counter.received += get_reply_size(response)
+            return response
+
+    client.connection_pool.connection_class = CountingConnection
+    return client
+
+
+class OperationStats:
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+
+    def summary(self):
+        count = len(self.latencies)
+        if not count:
+            return {"count": 0}
+        latencies = sorted(self.latencies)
+        total = sum(latencies)
+        return {
+            "count": count,
+            "ops_per_sec": round(count / total, 1) if total else None,
+            "p50_ms": round(latencies[int(count * 0.50)] * 1000, 4),
+            "p99_ms": round(latencies[min(int(count * 0.99), count - 1)] * 1000, 4),
+            "bytes_sent": self.sent,
+            "bytes_received": self.received,
+            "bytes_per_op": round((self.sent + self.received) / count, 1),
+        }
+
+
+class Command(BaseCommand):
+    help = ("Benchmark QueueService: simulate users joining, polling their position and being admitted, "
+            "then report ops/sec, p50/p99 latency and Redis bytes for every operation.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help="Number of users joining the queue.")
+        parser.add_argument('--joins-per-tick', type=int, default=1000, help="Users joining on every tick.")
+        parser.add_argument('--polls-per-tick', type=int, default=2000,
+                            help="Position polls by random waiting users on every tick.")
+        parser.add_argument('--admit-batch', type=int, default=100, help="Users admitted on every tick.")
+        parser.add_argument('--shards', type=int, default=1, help="Number of queue shards.")
+        parser.add_argument('--fake', action='store_true',
+                            help="Run against an in-process fakeredis server instead of REDIS_HOST.")
+        parser.add_argument('--event', default='benchmark', help="Queue namespace used for the run.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+
+    def get_client(self, fake):
+        if fake:
+            try:
+                import fakeredis
+            except ImportError:
+                raise CommandError("--fake needs the fakeredis package with Lua support (fakeredis[lua]).")
+            return fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        return redis.StrictRedis(host=settings.REDIS_HOST, port=int(settings.REDIS_PORT), db=settings.REDIS_QUEUE_DB)
+
+    def measure(self, stats, counter, operation, *args):
+        sent, received = counter.sent, counter.received
+        started = time.perf_counter()
+        result = operation(*args)
+        stats.latencies.append(time.perf_counter() - started)
+        stats.sent += counter.sent - sent
+        stats.received += counter.received - received
+        return result
+
+    def handle(self, *args, **options):
+        if options['admit_batch'] < 1 or options['joins_per_tick'] < 1:
+            raise CommandError("--admit-batch and --joins-per-tick must be positive.")
+        random.seed(options['seed'])
+        counter = ByteCounter()
+        client = count_bytes(self.get_client(options['fake']), counter)
+        queue_service = QueueService(event=options['event'], client=client, shards=options['shards'])
+        queue_service.clear_queue()
+
+        stats = {name: OperationStats() for name in ('join', 'poll', 'admit')}
+        user_ids = [str(user_id) for user_id in range(1, options['users'] + 1)]
+        # Admission is FIFO, so the users still waiting are about user_ids[admitted:joined].
+        joined = admitted = 0
+        started = time.perf_counter()
+        try:
+            while admitted < len(user_ids):
+                for user_id in user_ids[joined:joined + options['joins_per_tick']]:
+                    self.measure(stats['join'], counter, queue_service.add_to_queue, user_id)
+                joined = min(joined + options['joins_per_tick'], len(user_ids))
+
+                if admitted < joined:
+                    for _ in range(options['polls_per_tick']):
+                        user_id = user_ids[random.randrange(admitted, joined)]
+                        self.measure(stats['poll'], counter, queue_service.get_queue_status, user_id)
+
+                booking_tokens = self.measure(
+                    stats['admit'], counter, queue_service.process_queue, options['admit_batch']
+                )
+                if not booking_tokens and joined == len(user_ids):
+                    break
+                admitted += len(booking_tokens or ())
+        finally:
+            queue_service.clear_queue()
+            for offset in range(0, len(user_ids), 1000):
+                client.delete(*[queue_service.get_token_key(user_id) for user_id in user_ids[offset:offset + 1000]])
+
+        results = {
+            "created_at": timezone.now().isoformat(),
+            "backend": "fakeredis" if options['fake'] else f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}",
+            "config": {key: options[key] for key in ('users', 'joins_per_tick', 'polls_per_tick', 'admit_batch', 'shards', 'seed')},
+            "elapsed_sec": round(time.perf_counter() - started, 3),
+            "operations": {name: operation.summary() for name, operation in stats.items()},
+        }
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        self.stdout.write(output)
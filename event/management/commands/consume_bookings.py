@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from event.booking_commands import apply_booking_commands, get_booking_log
+
+
+class Command(BaseCommand):
+    help = ("Apply the booking commands published with BOOKING_ENGINE=kafka. Run one consumer per "
+            "group member, each applies the commands of its partitions in order.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-messages', type=int, default=500, help="Commands applied per transaction.")
+        parser.add_argument('--timeout', type=float, default=1.0, help="Seconds to wait for new commands.")
+
+    def handle(self, *args, **options):
+        log = get_booking_log()
+        try:
+            while True:
+                commands = [json.loads(value) for value in log.consume(options['max_messages'], options['timeout'])]
+                if not commands:
+                    continue
+                booked = apply_booking_commands(commands)
+                # Offsets are committed after the bookings, a crash in between redelivers commands that are skipped.
+                log.commit()
+                self.stdout.write(f"{len(commands)} booking commands applied, {booked} bookings created.")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            log.close()
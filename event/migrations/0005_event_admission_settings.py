@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event', '0004_remove_bookingtoken_event_queue_bookingtoken_event_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='admission_batch_size',
+            field=models.PositiveIntegerField(default=100),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='admission_tick_seconds',
+            field=models.PositiveSmallIntegerField(default=2),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event', '0005_event_admission_settings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='audit_booking_tokens',
+            field=models.BooleanField(default=False),
+        ),
+    ]
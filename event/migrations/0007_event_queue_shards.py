@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event', '0006_event_audit_booking_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='queue_shards',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event', '0007_event_queue_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticketbatch',
+            name='inventory_mode',
+            field=models.CharField(choices=[('database', 'Database'), ('redis', 'Redis')], default='database'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event', '0008_ticketbatch_inventory_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticketbatch',
+            name='inventory_slots',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AlterField(
+            model_name='ticketbatch',
+            name='inventory_mode',
+            field=models.CharField(choices=[('database', 'Database'), ('redis', 'Redis'), ('sharded', 'Sharded')], default='database'),
+        ),
+        migrations.CreateModel(
+            name='TicketBatchSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('number_of_tickets', models.PositiveIntegerField(default=0)),
+                ('tickets_sold', models.PositiveIntegerField(default=0)),
+                ('ticket_batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='event.ticketbatch')),
+            ],
+            options={
+                'unique_together': {('ticket_batch', 'index')},
+            },
+        ),
+    ]
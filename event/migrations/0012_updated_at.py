@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event', '0011_cancellation_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='ticketbatch',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
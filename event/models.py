@@ -1,16 +1,19 @@
 import uuid
 from django.db import models
-from django.utils import timezone
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.core.cache import cache
 from authentication.models import User
-from event.utils import generate_token, expire_view_cache
+from event.availability import invalidate_availability
+from event.stock_cache import invalidate_stock
+from event.utils import generate_token
+from event_ticketing.cache import bump_cache_version
 
 
 class Category(models.Model):
     name = models.CharField(max_length=255, unique=True)
     is_active = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -30,20 +33,15 @@ class Event(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     active_queue = models.BooleanField(default=False)
+    admission_batch_size = models.PositiveIntegerField(default=100)
+    admission_tick_seconds = models.PositiveSmallIntegerField(default=2)
+    audit_booking_tokens = models.BooleanField(default=False)
+    queue_shards = models.PositiveSmallIntegerField(default=1)
+    cancelled_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
-        """
-            At this development stage, only one EventQueue can be active at a time.
-            If the current EventQueue is being set as active, all others are deactivated.
-        """
-        if self.is_active:
-            Event.objects.filter(active_queue=True).update(active_queue=False)
-
-        super().save(*args, **kwargs)
-
 
 class TicketBatch(models.Model):
     class TicketTypeChoices(models.TextChoices):
@@ -51,16 +49,42 @@ class TicketBatch(models.Model):
         VIP = 'vip', 'VIP'
         DISCOUNT = 'discount', 'Discount'
 
+    class InventoryModeChoices(models.TextChoices):
+        DATABASE = 'database', 'Database'
+        REDIS = 'redis', 'Redis'
+        SHARDED = 'sharded', 'Sharded'
+
     event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='ticket_batches')
     ticket_type = models.CharField(choices=TicketTypeChoices.choices, default=TicketTypeChoices.STANDARD)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     number_of_tickets = models.PositiveIntegerField(default=0)
     tickets_sold = models.PositiveIntegerField(default=0)
+    inventory_mode = models.CharField(choices=InventoryModeChoices.choices, default=InventoryModeChoices.DATABASE)
+    inventory_slots = models.PositiveSmallIntegerField(default=1)
+    cancelled_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.event.name} - {self.ticket_type}"
 
 
+class TicketBatchSlot(models.Model):
+    """
+    Part of the stock of a TicketBatch with inventory_mode `sharded`. Bookings lock a
+    single slot instead of the batch row, number_of_tickets of the batch is the sum of its slots.
+    """
+    ticket_batch = models.ForeignKey(TicketBatch, on_delete=models.CASCADE, related_name='slots')
+    index = models.PositiveSmallIntegerField()
+    number_of_tickets = models.PositiveIntegerField(default=0)
+    tickets_sold = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['ticket_batch', 'index']
+
+    def __str__(self):
+        return f"{self.ticket_batch} - slot {self.index}"
+
+
 class Booking(models.Model):
     class BookingStatusChoices(models.TextChoices):
         PENDING = 'pending', 'Pending'
@@ -74,6 +98,7 @@ class Booking(models.Model):
     payment_status = models.CharField(choices=BookingStatusChoices.choices, default=BookingStatusChoices.PENDING)
     confirmed_at = models.DateTimeField(null=True, blank=True)
     cancelled_at = models.DateTimeField(null=True, blank=True)
+    hold_expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
     reference_code = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
 
     def generate_qr_string(self):
@@ -82,6 +107,34 @@ class Booking(models.Model):
         return qr_data
 
 
+class CancellationJob(models.Model):
+    """
+    Background cancellation of the bookings of an event, or of one of its ticket batches.
+    Bookings are cancelled in chunks ordered by id, a resumed job continues after last_booking_id.
+    """
+    class StatusChoices(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        RUNNING = 'running', 'Running'
+        COMPLETED = 'completed', 'Completed'
+        FAILED = 'failed', 'Failed'
+
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='cancellation_jobs')
+    ticket_batch = models.ForeignKey(
+        TicketBatch, on_delete=models.CASCADE, null=True, blank=True, related_name='cancellation_jobs'
+    )
+    requested_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='cancellation_jobs')
+    status = models.CharField(choices=StatusChoices.choices, default=StatusChoices.PENDING)
+    total_bookings = models.PositiveIntegerField(default=0)
+    cancelled_bookings = models.PositiveIntegerField(default=0)
+    last_booking_id = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.event} - {self.status}"
+
+
 class Feedback(models.Model):
     event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='reviews')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reviews')
@@ -91,14 +144,15 @@ class Feedback(models.Model):
 
 
 class BookingToken(models.Model):
+    """
+    Audit trail of issued booking tokens, written only for events with audit_booking_tokens.
+    The live tokens are kept in Redis by QueueService.
+    """
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='booking_tokens')
     event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='booking_tokens')
     token = models.CharField(max_length=255, default=generate_token, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
-    def is_valid(self):
-        return (timezone.now() - self.created_at).total_seconds() < 600
-
     def __str__(self):
         return f"{self.token}"
 
@@ -106,4 +160,20 @@ class BookingToken(models.Model):
 @receiver(post_save, sender=Event)
 @receiver(post_delete, sender=Event)
 def clear_event_cache(sender, instance, **kwargs):
-    expire_view_cache('event-list')
+    bump_cache_version('event')
+    invalidate_availability(instance.id)
+
+
+@receiver(post_save, sender=TicketBatch)
+def clear_ticket_batch_stock(sender, instance, update_fields=None, **kwargs):
+    """
+    Saves that only record sold tickets never free seats, any other save may restock the batch.
+    """
+    if update_fields is None or set(update_fields) != {'tickets_sold'}:
+        invalidate_stock(instance.id)
+        invalidate_availability(instance.event_id)
+
+
+@receiver(post_delete, sender=TicketBatch)
+def clear_ticket_batch_availability(sender, instance, **kwargs):
+    invalidate_availability(instance.event_id)
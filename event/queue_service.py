@@ -1,72 +1,420 @@
-import redis
+import json
+import time
+import zlib
+from collections import namedtuple
+
+from event.redis_client import get_redis
+from event.utils import generate_token
+
+RECENT_CHECKOUTS = 100
+TOKEN_EXPIRY_TIME = 60 * 10
+EXPIRED_SWEEP_LIMIT = 1000
+
+# Queue operations run as Lua scripts, so each one is a single round trip and
+# concurrent admission workers never observe a half-applied operation.
+
+# The join time is only kept (in the optional fourth key) by sharded queues, which merge on it.
+# KEYS: tickets, sequence, queue[, joined]  ARGV: user_id, now
+JOIN_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return 0
+end
+local ticket = redis.call('INCR', KEYS[2])
+redis.call('HSET', KEYS[1], ARGV[1], ticket)
+redis.call('RPUSH', KEYS[3], ARGV[1])
+if KEYS[4] then
+    redis.call('HSET', KEYS[4], ARGV[1], ARGV[2])
+end
+return ticket
+"""
+
+# KEYS: tickets[, joined]  ARGV: user_id
+LEAVE_SCRIPT = """
+if KEYS[2] then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+return redis.call('HDEL', KEYS[1], ARGV[1])
+"""
+
+# KEYS: tickets, head  ARGV: user_id
+POSITION_SCRIPT = """
+local ticket = redis.call('HGET', KEYS[1], ARGV[1])
+if not ticket then
+    return false
+end
+return tonumber(ticket) - tonumber(redis.call('GET', KEYS[2]) or '0')
+"""
+
+# Pops up to `count` users. Every popped entry advances the head, entries whose
+# ticket does not match the head belong to users who left the queue and are skipped.
+# Admitted users get their booking token with a native TTL (the token keys share the
+# event's hash tag, so they live in the same cluster slot as KEYS) and join the holders
+# window scored by their own expiry; at most `sweep limit` expired holders are removed
+# per call. The new head is published to the waiting room together with the tokens.
+# KEYS: queue, tickets, head, sequence, holders
+# ARGV: count, now, token ttl, sweep limit, token key prefix, updates channel, one token per user to admit
+ADMIT_SCRIPT = """
+local count = tonumber(ARGV[1])
+local head = tonumber(redis.call('GET', KEYS[3]) or '0')
+local admitted = {}
+local tokens = {}
+local expired = redis.call('ZRANGEBYSCORE', KEYS[5], '-inf', ARGV[2], 'LIMIT', 0, ARGV[4])
+if #expired > 0 then
+    redis.call('ZREM', KEYS[5], unpack(expired))
+end
+for _ = 1, count do
+    local user = redis.call('LPOP', KEYS[1])
+    if not user then
+        break
+    end
+    head = head + 1
+    if tonumber(redis.call('HGET', KEYS[2], user)) == head then
+        redis.call('HDEL', KEYS[2], user)
+        redis.call('ZADD', KEYS[5], tonumber(ARGV[2]) + tonumber(ARGV[3]), user)
+        admitted[#admitted + 1] = user
+        local token = ARGV[6 + #admitted]
+        redis.call('SET', ARGV[5] .. user, token, 'EX', ARGV[3])
+        tokens[user] = token
+    end
+end
+redis.call('SET', KEYS[3], head)
+if #admitted > 0 then
+    local sequence = tonumber(redis.call('GET', KEYS[4]) or '0')
+    redis.call('PUBLISH', ARGV[6], cjson.encode({heads = {head}, sequences = {sequence}, admitted = tokens}))
+end
+return admitted
+"""
+
+# Sharded admission runs in two steps because the shards live in different cluster slots:
+# peek at every shard's head, then admit on every shard the users that won the merge on join time.
+# Each shard keeps its own holders, checkouts and booking tokens, so admitting is atomic per shard.
+
+# Returns the head, the sequence and the first `count` waiting entries as {list index, user, join time}.
+# Entries without a join time are skipped like users who left.
+# KEYS: queue, tickets, joined, head, sequence  ARGV: count
+SHARD_PEEK_SCRIPT = """
+local head = tonumber(redis.call('GET', KEYS[4]) or '0')
+local entries = {}
+for index, user in ipairs(redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)) do
+    if tonumber(redis.call('HGET', KEYS[2], user)) == head + index then
+        local joined = redis.call('HGET', KEYS[3], user)
+        if joined then
+            entries[#entries + 1] = {index, user, joined}
+        end
+    end
+end
+return {head, tonumber(redis.call('GET', KEYS[5]) or '0'), entries}
+"""
+
+# Pops `count` list entries like ADMIT_SCRIPT and returns the new head and the admitted users.
+# Entries without a join time were skipped by the peek, they are dropped like users who left.
+# The published update carries the heads and sequences of all shards, with this shard's new head.
+# KEYS: queue, tickets, joined, head, holders
+# ARGV: count, now, token ttl, sweep limit, token key prefix, updates channel, heads and sequences as JSON,
+#       index of the shard in them, one token per user to admit
+SHARD_ADMIT_SCRIPT = """
+local head = tonumber(redis.call('GET', KEYS[4]) or '0')
+local admitted = {}
+local tokens = {}
+local expired = redis.call('ZRANGEBYSCORE', KEYS[5], '-inf', ARGV[2], 'LIMIT', 0, ARGV[4])
+if #expired > 0 then
+    redis.call('ZREM', KEYS[5], unpack(expired))
+end
+for _ = 1, tonumber(ARGV[1]) do
+    local user = redis.call('LPOP', KEYS[1])
+    if not user then
+        break
+    end
+    head = head + 1
+    if tonumber(redis.call('HGET', KEYS[2], user)) == head then
+        redis.call('HDEL', KEYS[2], user)
+        if redis.call('HDEL', KEYS[3], user) == 1 then
+            redis.call('ZADD', KEYS[5], tonumber(ARGV[2]) + tonumber(ARGV[3]), user)
+            admitted[#admitted + 1] = user
+            local token = ARGV[8 + #admitted]
+            redis.call('SET', ARGV[5] .. user, token, 'EX', ARGV[3])
+            tokens[user] = token
+        end
+    end
+end
+redis.call('SET', KEYS[4], head)
+if #admitted > 0 then
+    local update = cjson.decode(ARGV[7])
+    update['heads'][tonumber(ARGV[8])] = head
+    update['admitted'] = tokens
+    redis.call('PUBLISH', ARGV[6], cjson.encode(update))
+end
+return {head, admitted}
+"""
+
+# KEYS: holders, checkout_durations  ARGV: user_id, now, token ttl, recent checkouts kept
+CHECKOUT_SCRIPT = """
+local expires_at = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not expires_at then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('LPUSH', KEYS[2], tonumber(ARGV[2]) - (tonumber(expires_at) - tonumber(ARGV[3])))
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[4]) - 1)
+return 1
+"""
+
+ShardKeys = namedtuple('ShardKeys', ['queue', 'tickets', 'sequence', 'head', 'joined', 'holders', 'checkout_durations'])
 
 
 class QueueService:
-    def __init__(self, event):
+    def __init__(self, event, client=None, shards=1):
         """
         Initialize the QueueService with an event instance.
         :param event: The event object for which the queue is managed.
+        :param client: Redis client to use, defaults to the shared pooled client.
+        :param shards: Number of shards the event's queue is split across, see Event.queue_shards.
         """
-        self.redis = redis.StrictRedis(host='localhost', port=6379, db=0)
+        self.redis = client or get_redis()
         self.event = event
-        self.queue_key = f"event{self.event}:queue"
-        self.unique_set_key = f"event{self.event}:users"
-        self.allowed_users_set = f"event{self.event}:allowed_users"
+        self.shards = max(shards, 1)
+        # Every join takes the next ticket number from the shard's sequence and every admitted
+        # user advances its head, so a position within a shard is simply ticket minus head.
+        # The tickets hash also tells which users are waiting, so it doubles as the dedupe set.
+        # Keys carry the event id as hash tag, `{id}`, and shards of a sharded queue carry
+        # `{id:shard}`, so a cluster keeps each script's keys in one slot and spreads the shards.
+        # Every shard also keeps the users it admitted who have not checked out yet, scored by
+        # the expiry of their admission, and the durations of its most recent checkouts. Both feed
+        # the admission controller. Whether a user is admitted at all is answered by their booking
+        # token key, which carries the hash tag of the user's shard.
+        self.shard_keys = [self.get_shard_keys(shard) for shard in range(self.shards)]
+        self.token_key_prefixes = [f"event{{{self.get_shard_tag(shard)}}}:token:" for shard in range(self.shards)]
+        self.admission_tick_key = f"event{{{self.event}}}:admission_tick"
+        self.updates_channel = f"event{{{self.event}}}:updates"
+
+        self.join_script = self.redis.register_script(JOIN_SCRIPT)
+        self.leave_script = self.redis.register_script(LEAVE_SCRIPT)
+        self.position_script = self.redis.register_script(POSITION_SCRIPT)
+        self.admit_script = self.redis.register_script(ADMIT_SCRIPT)
+        self.shard_peek_script = self.redis.register_script(SHARD_PEEK_SCRIPT)
+        self.shard_admit_script = self.redis.register_script(SHARD_ADMIT_SCRIPT)
+        self.checkout_script = self.redis.register_script(CHECKOUT_SCRIPT)
+
+    def get_shard_tag(self, shard: int):
+        return self.event if self.shards == 1 else f"{self.event}:{shard}"
+
+    def get_shard_keys(self, shard: int):
+        tag = self.get_shard_tag(shard)
+        return ShardKeys(*(f"event{{{tag}}}:{name}" for name in ShardKeys._fields))
+
+    def get_shard(self, user_id: str) -> int:
+        if self.shards == 1:
+            return 0
+        return zlib.crc32(user_id.encode()) % self.shards
 
     def add_to_queue(self, user_id: str) -> bool:
         """
-        Add a user to the queue if not already present.
+        Add a user to the queue if not already present and hand out their ticket number.
         :param user_id: The unique ID of the user.
         :return: True if the user was added to the queue, False otherwise.
         """
-        if self.redis.sadd(self.unique_set_key, user_id):
-            self.redis.rpush(self.queue_key, user_id)
-            return True
-        return False
+        keys = self.shard_keys[self.get_shard(user_id)]
+        script_keys = [keys.tickets, keys.sequence, keys.queue]
+        if self.shards > 1:
+            script_keys.append(keys.joined)
+        ticket = self.join_script(keys=script_keys, args=[user_id, time.time()])
+        return bool(ticket)
 
     def get_user_position(self, user_id: str):
         """
-        Encode User's id, check if it is in the queue and returns position.
+        Look up the user's ticket and the queue head, position is their difference.
+        Sharded queues return an estimate, see estimate_position.
         :param user_id: Unique ID of the user.
         :return: position of user in queue
         """
-        queue = self.redis.lrange(self.queue_key, 0, -1)
-        encoded_user_id = user_id.encode()
-        if encoded_user_id in queue:
-            position = queue.index(encoded_user_id) + 1
-            return position
-        return "Not in queue"
+        if self.shards > 1:
+            return self.get_queue_status(user_id)[0]
+        keys = self.shard_keys[0]
+        position = self.position_script(keys=[keys.tickets, keys.head], args=[user_id])
+        if position is None:
+            return "Not in queue"
+        return position
+
+    def estimate_position(self, shard: int, ticket: int, heads: list, sequences: list):
+        """
+        Position within the user's own shard, plus for every other shard the users waiting
+        there, at most as many as are ahead of the user in their own shard. Users spread
+        evenly over the shards and are admitted in join order, so that is roughly how many
+        of them joined earlier. Exact for an unsharded queue.
+        """
+        ahead = max(ticket - heads[shard], 0)
+        others = sum(
+            min(max(sequence - head, 0), max(ahead - 1, 0))
+            for index, (head, sequence) in enumerate(zip(heads, sequences)) if index != shard
+        )
+        return ahead + others
+
+    def queue_status_commands(self, pipe, user_id: str):
+        """
+        Queue the reads behind get_queue_status on a pipeline, the async stream reuses them.
+        """
+        pipe.hget(self.shard_keys[self.get_shard(user_id)].tickets, user_id)
+        for keys in self.shard_keys:
+            pipe.get(keys.head)
+            pipe.get(keys.sequence)
+        pipe.get(self.get_token_key(user_id))
+
+    def parse_queue_status(self, user_id: str, results: list):
+        """
+        :return: the user's shard, ticket and position, and booking token if they were admitted.
+        """
+        ticket, *counters, booking_token = results
+        heads = [int(head or 0) for head in counters[0::2]]
+        sequences = [int(sequence or 0) for sequence in counters[1::2]]
+        shard = self.get_shard(user_id)
+        if ticket is None:
+            position = "Not in queue"
+        else:
+            ticket = int(ticket)
+            position = self.estimate_position(shard, ticket, heads, sequences)
+        return shard, ticket, position, booking_token.decode() if booking_token is not None else None
+
+    def get_queue_status(self, user_id: str):
+        """
+        Position and booking token of a user, fetched in one pipelined round trip.
+        :param user_id: Unique ID of the user.
+        :return: position of user in queue, booking token if the user was admitted.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        self.queue_status_commands(pipe, user_id)
+        _, _, position, booking_token = self.parse_queue_status(user_id, pipe.execute())
+        return position, booking_token
+
+    def leave_queue(self, user_id: str) -> bool:
+        """
+        Remove a user from the queue. Their list entry stays behind and is skipped on admission.
+        :param user_id: Unique ID of the user.
+        :return: True if the user was waiting in the queue.
+        """
+        keys = self.shard_keys[self.get_shard(user_id)]
+        script_keys = [keys.tickets]
+        if self.shards > 1:
+            script_keys.append(keys.joined)
+        return bool(self.leave_script(keys=script_keys, args=[user_id]))
 
     def process_queue(self, count=10):
-        self.clear_allowed_users()
-        users = self.redis.lpop(self.queue_key, count=count)
+        """
+        Admit up to `count` users and issue their booking tokens.
+        :return: booking token of every admitted user by user id, None if nobody was admitted.
+        """
+        if self.shards > 1:
+            return self.process_sharded_queue(count)
+        keys = self.shard_keys[0]
+        tokens = [generate_token() for _ in range(count)]
+        users = self.admit_script(
+            keys=[keys.queue, keys.tickets, keys.head, keys.sequence, keys.holders],
+            args=[
+                count, time.time(), TOKEN_EXPIRY_TIME, EXPIRED_SWEEP_LIMIT,
+                self.token_key_prefixes[0], self.updates_channel, *tokens,
+            ],
+        )
         if users:
-            self.redis.srem(self.unique_set_key, *users)
-            user_ids = [int(user.decode()) for user in users]
-
-            self.redis.sadd(self.allowed_users_set, *user_ids)
-            return user_ids
+            return {int(user.decode()): token for user, token in zip(users, tokens)}
         return None
 
-    def get_allowed_users(self):
-        allowed_users = self.redis.smembers(self.allowed_users_set)
-        decoded_users = [user_id.decode() for user_id in allowed_users]
-        return decoded_users
+    def process_sharded_queue(self, count):
+        """
+        Admit the `count` earliest joined users across all shards. The merge is approximately
+        FIFO: users who join while the shards are being peeked wait for the next tick.
+        """
+        heads, sequences, candidates = [], [], []
+        for shard, keys in enumerate(self.shard_keys):
+            head, sequence, entries = self.shard_peek_script(
+                keys=[keys.queue, keys.tickets, keys.joined, keys.head, keys.sequence], args=[count],
+            )
+            heads.append(head)
+            sequences.append(sequence)
+            candidates.extend((float(joined_at), shard, index) for index, _, joined_at in entries)
+
+        # Pop every shard up to the list index of its last user that made the cut.
+        pops = [0] * self.shards
+        for _, shard, index in sorted(candidates)[:count]:
+            pops[shard] = max(pops[shard], index)
+
+        booking_tokens = {}
+        for shard, pop_count in enumerate(pops):
+            if not pop_count:
+                continue
+            keys = self.shard_keys[shard]
+            tokens = [generate_token() for _ in range(pop_count)]
+            heads[shard], users = self.shard_admit_script(
+                keys=[keys.queue, keys.tickets, keys.joined, keys.head, keys.holders],
+                args=[
+                    pop_count, time.time(), TOKEN_EXPIRY_TIME, EXPIRED_SWEEP_LIMIT,
+                    self.token_key_prefixes[shard], self.updates_channel,
+                    json.dumps({"heads": heads, "sequences": sequences}), shard + 1, *tokens,
+                ],
+            )
+            booking_tokens.update({int(user.decode()): token for user, token in zip(users, tokens)})
+        return booking_tokens or None
+
+    def get_token_key(self, user_id: str):
+        return f"{self.token_key_prefixes[self.get_shard(user_id)]}{user_id}"
 
-    def clear_allowed_users(self):
-        self.redis.delete(self.allowed_users_set)
+    def get_booking_token(self, user_id: str):
+        """
+        :param user_id: Unique ID of the user.
+        :return: the user's booking token, None if they were not admitted or it expired.
+        """
+        booking_token = self.redis.get(self.get_token_key(user_id))
+        return booking_token.decode() if booking_token is not None else None
+
+    def record_checkout(self, user_id: str):
+        """
+        Mark an admitted user as checked out and remember how long the checkout took.
+        :param user_id: Unique ID of the user.
+        """
+        keys = self.shard_keys[self.get_shard(user_id)]
+        self.checkout_script(
+            keys=[keys.holders, keys.checkout_durations],
+            args=[user_id, time.time(), TOKEN_EXPIRY_TIME, RECENT_CHECKOUTS],
+        )
+
+    def get_admission_stats(self):
+        """
+        Admission signals. Holders whose admission expired but were not swept yet are not counted.
+        :return: number of admitted users still holding a token, recent checkout durations.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for keys in self.shard_keys:
+            pipe.zcount(keys.holders, f"({time.time()}", '+inf')
+            pipe.lrange(keys.checkout_durations, 0, -1)
+        results = pipe.execute()
+        return sum(results[0::2]), [float(duration) for durations in results[1::2] for duration in durations]
+
+    def claim_admission_tick(self, seconds: int) -> bool:
+        """
+        Claim the next admission tick, at most one claim succeeds per `seconds`.
+        The claim expires slightly early so scheduler jitter does not skip a tick.
+        :param seconds: Length of the event's admission tick.
+        :return: True if admission should run now.
+        """
+        return bool(self.redis.set(self.admission_tick_key, 1, nx=True, px=max(seconds * 1000 - 100, 100)))
 
     def get_queue_length(self):
         """
-        Get the length of the queue.
+        Get the length of the queue from the issued ticket numbers and the heads.
+        Users who left and were not reached by admission yet are still counted.
         :return:  The number of users in the queue.
         """
-        return self.redis.llen(self.queue_key)
+        pipe = self.redis.pipeline(transaction=False)
+        for keys in self.shard_keys:
+            pipe.get(keys.sequence)
+            pipe.get(keys.head)
+        counters = [int(counter or 0) for counter in pipe.execute()]
+        return sum(counters[0::2]) - sum(counters[1::2])
 
     def clear_queue(self):
         """
-        Clear the entire queue and unique set for the event.
+        Clear the entire queue and its bookkeeping for the event.
         """
-        self.redis.delete(self.queue_key)
-        self.redis.delete(self.unique_set_key)
-        self.redis.delete(self.allowed_users_set)
+        pipe = self.redis.pipeline(transaction=False)
+        for keys in self.shard_keys:
+            pipe.delete(*keys)
+        pipe.delete(self.admission_tick_key)
+        pipe.execute()
@@ -0,0 +1,47 @@
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_pool = None
+
+
+def get_connection_pool():
+    """
+    Build the connection pool once per process from settings.
+    Connections idle for longer than REDIS_HEALTH_CHECK_INTERVAL are checked with PING before reuse.
+    """
+    global _pool
+    if _pool is None:
+        _pool = redis.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=int(settings.REDIS_PORT),
+            db=settings.REDIS_QUEUE_DB,
+            max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+        )
+    return _pool
+
+
+def get_redis():
+    """
+    Return a client backed by the shared connection pool.
+    """
+    return redis.StrictRedis(connection_pool=get_connection_pool())
+
+
+def create_async_redis():
+    """
+    Build an asyncio client from the same settings. Asyncio connections are bound to
+    the event loop that opened them, so callers keep one client per loop.
+    """
+    return redis.asyncio.StrictRedis(
+        host=settings.REDIS_HOST,
+        port=int(settings.REDIS_PORT),
+        db=settings.REDIS_QUEUE_DB,
+        max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
@@ -2,7 +2,7 @@ from django.db.models import Sum
 from django.utils.timezone import now
 from rest_framework import serializers
 
-from event.models import Event, Category, TicketBatch, Booking
+from event.models import Event, Category, TicketBatch, Booking, CancellationJob
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -17,9 +17,22 @@ class EventSerializer(serializers.ModelSerializer):
     class Meta:
         model = Event
         fields = ['id', 'category', 'host', 'name', 'description', 'start_date', 'end_date', 'location', 'address',
-                  'max_attendance', 'active_queue']
+                  'max_attendance', 'active_queue', 'admission_batch_size', 'admission_tick_seconds',
+                  'audit_booking_tokens', 'queue_shards']
         read_only_fields = ['host', 'active_queue']
 
+    def validate_admission_tick_seconds(self, value):
+        if value < 1:
+            raise serializers.ValidationError("Admission tick must be at least one second.")
+        return value
+
+    def validate_queue_shards(self, value):
+        if value < 1:
+            raise serializers.ValidationError("The queue needs at least one shard.")
+        if self.instance and self.instance.active_queue and value != self.instance.queue_shards:
+            raise serializers.ValidationError("Queue shards can not be changed while the queue is active.")
+        return value
+
     def validate(self, attrs):
         end_date = attrs['end_date']
         if end_date and end_date <= attrs['start_date']:
@@ -29,17 +42,38 @@ class EventSerializer(serializers.ModelSerializer):
 
 class TicketBatchSerializer(serializers.ModelSerializer):
     event = serializers.PrimaryKeyRelatedField(queryset=Event.objects.all())
+    tickets_sold = serializers.SerializerMethodField()
 
     class Meta:
         model = TicketBatch
-        fields = ['id', 'event', 'ticket_type', 'price', 'number_of_tickets', 'tickets_sold']
-        read_only_fields = ['tickets_sold']
+        fields = ['id', 'event', 'ticket_type', 'price', 'number_of_tickets', 'tickets_sold', 'inventory_mode',
+                  'inventory_slots']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         user = self.context['request'].user
         self.fields['event'].queryset = Event.objects.filter(host=user)
 
+    def validate_inventory_mode(self, value):
+        if self.instance and value != self.instance.inventory_mode:
+            raise serializers.ValidationError("Inventory mode can only be chosen when the ticket batch is created.")
+        return value
+
+    def validate_inventory_slots(self, value):
+        if value < 1:
+            raise serializers.ValidationError("A ticket batch needs at least one inventory slot.")
+        if self.instance and value != self.instance.inventory_slots:
+            raise serializers.ValidationError("Inventory slots can only be chosen when the ticket batch is created.")
+        return value
+
+    def get_tickets_sold(self, obj):
+        """
+        Sharded batches sell from their slots, the total is summed from the prefetched slots.
+        """
+        if obj.inventory_mode == TicketBatch.InventoryModeChoices.SHARDED:
+            return sum(slot.tickets_sold for slot in obj.slots.all())
+        return obj.tickets_sold
+
     def validate(self, attrs):
         user = self.context['request'].user
         event = attrs['event']
@@ -65,23 +99,43 @@ class BookingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Booking
         fields = ['id', 'user', 'event', 'ticket_batch', 'ticket_count', 'payment_status', 'confirmed_at',
-                  'cancelled_at', 'reference_code']
-        read_only_fields = ['user', 'event', 'payment_status', 'confirmed_at', 'cancelled_at', 'reference_code']
+                  'cancelled_at', 'hold_expires_at', 'reference_code']
+        read_only_fields = ['user', 'event', 'payment_status', 'confirmed_at', 'cancelled_at', 'hold_expires_at',
+                            'reference_code']
 
     def validate(self, attrs):
         event = self.context['event']
         ticket_batch = attrs['ticket_batch']
-        if ticket_batch.event != event:
+        if ticket_batch.event_id != event.id:
             raise serializers.ValidationError("Ticket batch does not belong to the event.")
+        if event.cancelled_at or ticket_batch.cancelled_at:
+            raise serializers.ValidationError("The event or ticket batch is cancelled.")
         return attrs
 
     def create(self, validated_data):
-        validated_data['payment_status'] = Booking.BookingStatusChoices.CONFIRMED
-        validated_data['confirmed_at'] = now()
+        if validated_data.get('hold_expires_at'):
+            validated_data['payment_status'] = Booking.BookingStatusChoices.PENDING
+        else:
+            validated_data['payment_status'] = Booking.BookingStatusChoices.CONFIRMED
+            validated_data['confirmed_at'] = now()
 
         return super().create(validated_data)
 
 
+class CartSerializer(serializers.Serializer):
+    items = BookingSerializer(many=True)
+
+    def validate_items(self, value):
+        if not value:
+            raise serializers.ValidationError("The cart is empty.")
+        ticket_batches = [item['ticket_batch'] for item in value]
+        if len({ticket_batch.id for ticket_batch in ticket_batches}) != len(ticket_batches):
+            raise serializers.ValidationError("Each ticket batch can only be added to the cart once.")
+        if any(ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.REDIS for ticket_batch in ticket_batches):
+            raise serializers.ValidationError("Ticket batches with the redis inventory mode can not be booked in a cart.")
+        return value
+
+
 class QrCodeSerializer(serializers.ModelSerializer):
     qr_code_string = serializers.SerializerMethodField()
 
@@ -91,3 +145,23 @@ class QrCodeSerializer(serializers.ModelSerializer):
 
     def get_qr_code_string(self, obj):
         return obj.generate_qr_string()
+
+
+class CancellationJobSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CancellationJob
+        fields = ['id', 'event', 'ticket_batch', 'requested_by', 'status', 'total_bookings', 'cancelled_bookings',
+                  'progress', 'created_at', 'updated_at', 'finished_at']
+        read_only_fields = fields
+
+    def get_progress(self, obj):
+        """
+        Share of the bookings cancelled so far, capped because late bookings are cancelled too.
+        """
+        if obj.status == CancellationJob.StatusChoices.COMPLETED:
+            return 1.0
+        if not obj.total_bookings:
+            return 0.0
+        return round(min(obj.cancelled_bookings / obj.total_bookings, 1.0), 4)
@@ -0,0 +1,72 @@
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from event.redis_client import get_redis
+
+LOW_STOCK_THRESHOLD = 20
+STOCK_BOUND_TTL = 300
+
+# Publish the bound only if no restock happened since the caller read the generation.
+# KEYS: bound, generation  ARGV: generation read by the caller, bound, ttl
+PUBLISH_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# KEYS: bound, generation
+INVALIDATE_SCRIPT = """
+redis.call('INCR', KEYS[2])
+return redis.call('DEL', KEYS[1])
+"""
+
+
+class StockCache:
+    def __init__(self, ticket_batch_id, client=None):
+        """
+        Upper bound of the tickets left in a batch. It is published when a booking finds the batch
+        sold out or nearly sold out, so later requests are rejected before any SQL runs.
+        Freeing seats clears the bound and bumps a generation, so a bound read before the
+        restock is never published after it.
+        :param ticket_batch_id: ID of the ticket batch.
+        :param client: Redis client to use, defaults to the shared pooled client.
+        """
+        self.redis = client or get_redis()
+        self.bound_key = f"ticket_batch{{{ticket_batch_id}}}:stock_bound"
+        self.generation_key = f"ticket_batch{{{ticket_batch_id}}}:stock_generation"
+        self.generation = None
+
+        self.publish_script = self.redis.register_script(PUBLISH_SCRIPT)
+        self.invalidate_script = self.redis.register_script(INVALIDATE_SCRIPT)
+
+    def check(self, ticket_count: int):
+        """
+        Reject a booking the published bound can not satisfy, and remember the generation for publish().
+        """
+        bound, generation = self.redis.mget(self.bound_key, self.generation_key)
+        self.generation = int(generation or 0)
+        if bound is None:
+            return
+        if int(bound) <= 0:
+            raise ValidationError("Ticket batch is sold out.", code='sold_out')
+        if ticket_count > int(bound):
+            raise ValidationError("Not enough tickets available for booking.")
+
+    def publish(self, remaining: int):
+        if self.generation is None or remaining > LOW_STOCK_THRESHOLD:
+            return
+        self.publish_script(
+            keys=[self.bound_key, self.generation_key], args=[self.generation, max(remaining, 0), STOCK_BOUND_TTL],
+        )
+
+    def invalidate(self):
+        self.invalidate_script(keys=[self.bound_key, self.generation_key])
+
+
+def invalidate_stock(ticket_batch_id):
+    """
+    Clear the published bound once the transaction that frees seats of the batch commits.
+    """
+    transaction.on_commit(lambda: StockCache(ticket_batch_id).invalidate())
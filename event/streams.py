@@ -0,0 +1,170 @@
+import asyncio
+import json
+import logging
+import weakref
+from collections import defaultdict
+
+from django.http import JsonResponse, StreamingHttpResponse
+
+from event.models import Event
+from event.queue_service import QueueService
+from event.redis_client import create_async_redis
+
+HEARTBEAT_INTERVAL = 15
+SUBSCRIBE_TIMEOUT = 5
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+UPDATES_PATTERN = "event*:updates"
+
+logger = logging.getLogger(__name__)
+
+
+class QueueUpdateHub:
+    def __init__(self):
+        """
+        One Redis pub/sub connection per process, fanned out to the clients streaming
+        from this process, so an admission tick costs a single publish however many
+        users are waiting. A lost connection is reopened with backoff, listeners then get
+        None, as updates published in between were missed.
+        """
+        self.redis = create_async_redis()
+        self.listeners = defaultdict(set)
+        self.task = None
+        self.ready = asyncio.Event()
+
+    async def subscribe(self, channel):
+        """
+        Register a listener for the channel, once the pattern subscription is active.
+        :raise TimeoutError: if Redis can not be subscribed within SUBSCRIBE_TIMEOUT seconds.
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        listener = asyncio.Queue()
+        self.listeners[channel].add(listener)
+        try:
+            await asyncio.wait_for(self.ready.wait(), SUBSCRIBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.unsubscribe(channel, listener)
+            raise
+        return listener
+
+    def unsubscribe(self, channel, listener):
+        self.listeners[channel].discard(listener)
+        if not self.listeners[channel]:
+            del self.listeners[channel]
+
+    def notify_all(self, update):
+        for listeners in self.listeners.values():
+            for listener in listeners:
+                listener.put_nowait(update)
+
+    async def run(self):
+        delay = RECONNECT_DELAY
+        reconnecting = False
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(UPDATES_PATTERN)
+                self.ready.set()
+                delay = RECONNECT_DELAY
+                if reconnecting:
+                    self.notify_all(None)
+                async for message in pubsub.listen():
+                    channel = message['channel'].decode()
+                    if channel not in self.listeners:
+                        continue
+                    update = json.loads(message['data'])
+                    for listener in self.listeners[channel]:
+                        listener.put_nowait(update)
+            except Exception:
+                logger.exception("Queue updates subscription failed, reconnecting in %s seconds.", delay)
+            finally:
+                self.ready.clear()
+                await pubsub.aclose()
+            reconnecting = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    """
+    Hubs are kept per event loop because asyncio connections cannot be shared across loops.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _hubs:
+        _hubs[loop] = QueueUpdateHub()
+    return _hubs[loop]
+
+
+def format_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def queue_stream(request, pk):
+    """
+    Server-sent events for the waiting room: a `position` event whenever the queue head
+    moves and a final `admitted` event with the booking token. Requires an ASGI server.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=403)
+    queue_shards = await (
+        Event.objects.filter(pk=pk, active_queue=True).values_list('queue_shards', flat=True).afirst()
+    )
+    if queue_shards is None:
+        return JsonResponse({"detail": "The EventQueue is not active."}, status=404)
+
+    hub = get_hub()
+    queue_service = QueueService(event=pk, client=hub.redis, shards=queue_shards)
+    user_id = str(user.id)
+
+    async def read_status():
+        async with hub.redis.pipeline(transaction=False) as pipe:
+            queue_service.queue_status_commands(pipe, user_id)
+            results = await pipe.execute()
+        return queue_service.parse_queue_status(user_id, results)
+
+    async def stream():
+        # Subscribe before reading the current state so no admission is missed in between.
+        listener = await hub.subscribe(queue_service.updates_channel)
+        try:
+            shard, ticket, position, booking_token = await read_status()
+
+            if booking_token is not None:
+                yield format_event('admitted', {"booking_token": booking_token})
+                return
+            yield format_event('position', {"position": position})
+            if ticket is None:
+                return
+
+            while True:
+                try:
+                    update = await asyncio.wait_for(listener.get(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if update is None:
+                    # The hub reconnected, updates may have been missed.
+                    _, ticket, position, booking_token = await read_status()
+                    if booking_token is not None:
+                        yield format_event('admitted', {"booking_token": booking_token})
+                        return
+                    yield format_event('position', {"position": position})
+                    if ticket is None:
+                        return
+                    continue
+                if user_id in update['admitted']:
+                    yield format_event('admitted', {"booking_token": update['admitted'][user_id]})
+                    return
+                position = queue_service.estimate_position(shard, ticket, update['heads'], update['sequences'])
+                yield format_event('position', {"position": position})
+        finally:
+            hub.unsubscribe(queue_service.updates_channel, listener)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,30 +1,122 @@
-from datetime import timedelta
 from celery import shared_task
-from django.utils import timezone
+from django.conf import settings
 
-from event.models import BookingToken, Event
-from event.queue_service import QueueService
-
-TOKEN_EXPIRY_TIME = 60 * 10
+from event.admission import AdmissionController
+from event.cancellation import cancel_next_chunk
+from event.inventory import RedisInventory, flush_ticket_batch, reconcile_ticket_batch, release_expired_holds
+from event.models import BookingToken, CancellationJob, Event, TicketBatch
+from event.queue_service import QueueService, TOKEN_EXPIRY_TIME
+from event.redis_client import get_redis
 
 
 @shared_task
 def process_event_queue():
-    BookingToken.objects.filter(created_at__lte=timezone.now() - timedelta(seconds=TOKEN_EXPIRY_TIME)).delete()
+    """
+    Fan out admission: every event with an active queue whose admission tick is due
+    gets its own admit_event_queue task, so workers admit users for different events in parallel.
+    """
+    events = Event.objects.filter(active_queue=True).values_list('id', 'admission_tick_seconds')
+    for event_id, tick_seconds in events:
+        if QueueService(event=event_id).claim_admission_tick(tick_seconds):
+            admit_event_queue.delay(event_id)
+
+
+@shared_task
+def admit_event_queue(event_id):
+    """
+    Admit the next batch of users from a single event's queue, their booking tokens are issued in Redis.
+    The batch size is set by the AdmissionController on every tick.
+    """
+    event = Event.objects.get(id=event_id)
+    queue_service = QueueService(event=event_id, shards=event.queue_shards)
+    count = AdmissionController(event, queue_service, TOKEN_EXPIRY_TIME).next_batch_size()
+    if not count:
+        return
+    booking_tokens = queue_service.process_queue(count=count)
+    if booking_tokens:
+        if event.audit_booking_tokens:
+            record_booking_tokens.delay(event_id, booking_tokens)
+        print(f"Event {event_id} Queue processed successfully.")
+
+
+@shared_task
+def record_booking_tokens(event_id, booking_tokens):
+    """
+    Write the audit trail of issued booking tokens for events that opted in.
+    """
+    BookingToken.objects.bulk_create(
+        [BookingToken(user_id=user_id, event_id=event_id, token=token) for user_id, token in booking_tokens.items()]
+    )
+
+
+@shared_task
+def flush_pending_bookings():
+    """
+    Fan out the write-behind of redis inventory batches: every batch with bookings
+    waiting in Redis gets its own flush_ticket_batch_bookings task.
+    """
+    ticket_batch_ids = list(
+        TicketBatch.objects.filter(inventory_mode=TicketBatch.InventoryModeChoices.REDIS).values_list('id', flat=True)
+    )
+    redis = get_redis()
+    with redis.pipeline(transaction=False) as pipe:
+        for ticket_batch_id in ticket_batch_ids:
+            pipe.llen(RedisInventory(ticket_batch_id, client=redis).pending_key)
+        pending = pipe.execute()
+    for ticket_batch_id, count in zip(ticket_batch_ids, pending):
+        if count:
+            flush_ticket_batch_bookings.delay(ticket_batch_id)
+
+
+@shared_task
+def flush_ticket_batch_bookings(ticket_batch_id):
+    """
+    Save the bookings reserved in Redis for a single ticket batch and add them to tickets_sold.
+    """
+    flushed = flush_ticket_batch(ticket_batch_id)
+    if flushed:
+        print(f"Ticket batch {ticket_batch_id}: {flushed} bookings saved.")
+
+
+@shared_task
+def reconcile_inventory():
+    """
+    Periodically fix drift between the Redis counters and the database for all redis inventory batches.
+    """
+    ticket_batch_ids = TicketBatch.objects.filter(
+        inventory_mode=TicketBatch.InventoryModeChoices.REDIS
+    ).values_list('id', flat=True)
+    for ticket_batch_id in ticket_batch_ids:
+        reconcile_ticket_batch_inventory.delay(ticket_batch_id)
+
+
+@shared_task
+def reconcile_ticket_batch_inventory(ticket_batch_id):
+    reconcile_ticket_batch(ticket_batch_id)
+
+
+@shared_task
+def release_booking_holds():
+    """
+    Cancel bookings whose hold expired and return their tickets to the ticket batches in bulk.
+    """
+    released = release_expired_holds(settings.HOLD_SWEEP_LIMIT)
+    if released:
+        print(f"{released} expired booking holds released.")
+
+
+@shared_task
+def run_cancellation_job(job_id):
+    """
+    Cancel the bookings of a CancellationJob chunk by chunk, an interrupted job is resumed by running it again.
+    """
+    CancellationJob.objects.filter(id=job_id).exclude(
+        status=CancellationJob.StatusChoices.COMPLETED
+    ).update(status=CancellationJob.StatusChoices.RUNNING)
     try:
-        event = Event.objects.get(active_queue=True)
-    except Event.DoesNotExist:
-        event = None
-    if event:
-        queue_service = QueueService(event=event.id)
-        user_ids = queue_service.process_queue()
-        if user_ids:
-            booking_tokens = [BookingToken(user_id=user_id, event=event) for user_id in user_ids]
-            if booking_tokens:
-                BookingToken.objects.bulk_create(booking_tokens)
-                print("Booking tokens created successfully.")
-            print("Event Queue processed successfully.")
-        else:
-            print("No users in the queue.")
-    else:
-        print("No active Event Queue found.")
+        while cancel_next_chunk(job_id, settings.CANCELLATION_CHUNK_SIZE):
+            pass
+    except Exception:
+        CancellationJob.objects.filter(id=job_id).update(status=CancellationJob.StatusChoices.FAILED)
+        raise
+    print(f"Cancellation job {job_id} completed.")
@@ -0,0 +1,38 @@
+import fakeredis
+from django.test import SimpleTestCase
+
+from event.availability import Availability
+
+
+class AvailabilityTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.availability = Availability(1, client=self.redis)
+
+    def test_load_is_published(self):
+        self.assertIsNone(self.availability.read())
+        self.availability.publish({10: 5, 11: 0})
+
+        self.assertEqual(Availability(1, client=self.redis).read(), {10: 5, 11: 0})
+
+    def test_adjust_during_load_keeps_the_load(self):
+        # A booking committed while the hash is missing must not discard the load in progress.
+        self.assertIsNone(self.availability.read())
+        Availability(1, client=self.redis).adjust(10, -1)
+        self.availability.publish({10: 4})
+
+        self.assertEqual(Availability(1, client=self.redis).read(), {10: 4})
+
+    def test_adjust_moves_a_loaded_hash(self):
+        self.availability.read()
+        self.availability.publish({10: 5})
+        self.availability.adjust(10, -2)
+
+        self.assertEqual(self.availability.read(), {10: 3})
+
+    def test_load_invalidated_in_between_is_discarded(self):
+        self.assertIsNone(self.availability.read())
+        Availability(1, client=self.redis).invalidate()
+        self.availability.publish({10: 5})
+
+        self.assertIsNone(Availability(1, client=self.redis).read())
@@ -0,0 +1,90 @@
+from unittest import mock
+
+from django.utils.timezone import now
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+
+from authentication.models import User
+from event.booking_engine import SingleStatementBookingEngine
+from event.inventory import distribute_slots
+from event.models import Booking, Category, Event, TicketBatch, TicketBatchSlot
+
+
+@mock.patch('event.views.StockCache', mock.MagicMock())
+@mock.patch('event.views.get_booking_engine', mock.Mock(return_value=SingleStatementBookingEngine()))
+class SingleStatementBookingTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        host = User.objects.create_user(email='host@example.com', password='password')
+        category = Category.objects.create(name='Concerts', is_active=True)
+        self.event = Event.objects.create(
+            category=category, host=host, name='Concert', start_date=now(), location='Hall', max_attendance=10,
+        )
+        self.ticket_batch = TicketBatch.objects.create(event=self.event, number_of_tickets=3)
+        self.url = reverse('event-booking', kwargs={'pk': self.event.id})
+        self.client.force_authenticate(self.user)
+
+    def test_booking_query_count(self):
+        # The event, the ticket batch of the serializer and the booking statement.
+        with self.assertNumQueries(3):
+            response = self.client.post(self.url, {'ticket_batch': self.ticket_batch.id, 'ticket_count': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.ticket_batch.refresh_from_db()
+        self.assertEqual(self.ticket_batch.tickets_sold, 2)
+        booking = Booking.objects.get(id=response.data['id'])
+        self.assertEqual(booking.ticket_count, 2)
+        self.assertEqual(booking.payment_status, Booking.BookingStatusChoices.CONFIRMED)
+
+    def test_booking_more_tickets_than_left(self):
+        response = self.client.post(self.url, {'ticket_batch': self.ticket_batch.id, 'ticket_count': 4})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.ticket_batch.refresh_from_db()
+        self.assertEqual(self.ticket_batch.tickets_sold, 0)
+        self.assertFalse(Booking.objects.exists())
+
+
+@mock.patch('event.views.StockCache', mock.MagicMock())
+class ShardedBookingTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        host = User.objects.create_user(email='host@example.com', password='password')
+        category = Category.objects.create(name='Concerts', is_active=True)
+        self.event = Event.objects.create(
+            category=category, host=host, name='Concert', start_date=now(), location='Hall', max_attendance=10,
+        )
+        self.ticket_batch = TicketBatch.objects.create(
+            event=self.event, number_of_tickets=8, inventory_mode=TicketBatch.InventoryModeChoices.SHARDED,
+            inventory_slots=4,
+        )
+        distribute_slots(self.ticket_batch)
+        self.url = reverse('event-booking', kwargs={'pk': self.event.id})
+        self.client.force_authenticate(self.user)
+
+    def get_slots_sold(self):
+        return list(TicketBatchSlot.objects.filter(ticket_batch=self.ticket_batch).order_by('index')
+                    .values_list('tickets_sold', flat=True))
+
+    def test_booking_split_over_slots(self):
+        # Every slot has 2 tickets, so 3 tickets are taken from the slots in index order.
+        response = self.client.post(self.url, {'ticket_batch': self.ticket_batch.id, 'ticket_count': 3})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.get_slots_sold(), [2, 1, 0, 0])
+
+        response = self.client.post(self.url, {'ticket_batch': self.ticket_batch.id, 'ticket_count': 5})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.get_slots_sold(), [2, 2, 2, 2])
+        self.assertEqual(Booking.objects.filter(ticket_batch=self.ticket_batch).count(), 2)
+
+    def test_booking_split_more_tickets_than_left(self):
+        TicketBatchSlot.objects.filter(ticket_batch=self.ticket_batch, index__lt=3).update(tickets_sold=2)
+
+        response = self.client.post(self.url, {'ticket_batch': self.ticket_batch.id, 'ticket_count': 3})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_slots_sold(), [2, 2, 2, 0])
+        self.assertFalse(Booking.objects.exists())
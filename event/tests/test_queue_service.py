@@ -0,0 +1,49 @@
+from unittest import mock
+
+import fakeredis
+from django.test import SimpleTestCase
+
+from event.queue_service import QueueService
+
+
+@mock.patch('event.queue_service.time.time', mock.Mock(side_effect=range(1000, 2000)))
+class ShardedQueueServiceTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.queue_service = QueueService(event=1, client=self.redis, shards=2)
+        # Users 1 to 3 hash to shard 1, users 4 to 6 to shard 0.
+        for user_id in range(1, 7):
+            self.queue_service.add_to_queue(str(user_id))
+
+    def test_admission_merges_shards_on_join_time(self):
+        booking_tokens = self.queue_service.process_queue(3)
+
+        self.assertEqual(sorted(booking_tokens), [1, 2, 3])
+        for user_id, booking_token in booking_tokens.items():
+            self.assertEqual(self.queue_service.get_booking_token(str(user_id)), booking_token)
+        self.assertEqual(self.queue_service.get_admission_stats(), (3, []))
+
+    def test_booking_tokens_live_in_the_shard_slot(self):
+        self.queue_service.process_queue(6)
+
+        self.assertEqual(self.queue_service.get_token_key('1'), 'event{1:1}:token:1')
+        self.assertEqual(self.queue_service.get_token_key('4'), 'event{1:0}:token:4')
+
+    def test_front_of_every_shard_is_first(self):
+        self.assertEqual(self.queue_service.get_user_position('1'), 1)
+        self.assertEqual(self.queue_service.get_user_position('4'), 1)
+        self.assertEqual(self.queue_service.get_user_position('6'), 5)
+
+    def test_left_user_is_skipped(self):
+        self.assertTrue(self.queue_service.leave_queue('2'))
+
+        self.assertEqual(self.queue_service.get_user_position('2'), "Not in queue")
+        self.assertEqual(sorted(self.queue_service.process_queue(3)), [1, 3, 4])
+
+    def test_entry_without_join_time_is_dropped(self):
+        # A leave that only removed the join time, left behind by an interrupted leave.
+        self.redis.hdel(self.queue_service.shard_keys[1].joined, '1')
+
+        self.assertEqual(sorted(self.queue_service.process_queue(2)), [2, 4])
+        self.assertEqual(self.queue_service.get_user_position('1'), "Not in queue")
+        self.assertIsNone(self.queue_service.get_booking_token('1'))
@@ -1,6 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from event.views import EventViewSet, CategoryViewSet, TicketBatchViewSet, BookingViewSet
+from event.streams import queue_stream
+from event.views import EventViewSet, CategoryViewSet, TicketBatchViewSet, BookingViewSet, CancellationJobViewSet
 
 router = DefaultRouter()
 
@@ -8,7 +9,9 @@ router.register(r'event', EventViewSet, basename='event')
 router.register(r'category', CategoryViewSet, basename='category')
 router.register(r'ticket_batch', TicketBatchViewSet, basename='ticket_batch')
 router.register(r'booking', BookingViewSet, basename='booking')
+router.register(r'cancellation_job', CancellationJobViewSet, basename='cancellation_job')
 
 urlpatterns = [
+    path('event/<int:pk>/queue/stream/', queue_stream, name='event-queue-stream'),
     path('', include(router.urls)),
 ]
@@ -1,25 +1,45 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import transaction
-from django.db.models import F
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from django.db.models import Count, Max, Sum
+from django.utils.timezone import now
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
-from rest_framework.exceptions import ValidationError, PermissionDenied
+from rest_framework.exceptions import ValidationError, PermissionDenied, NotFound
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.viewsets import mixins
+from event_ticketing.cache import cache_response, get_fragments, conditional, ConditionalGetMixin
+from event.booking_commands import submit_booking, get_booking_status
+from event.booking_engine import get_booking_engine
+from event.cancellation import start_cancellation
+from event.idempotency import idempotent
+from event.inventory import reserve_booking, distribute_slots, take_slot_tickets, take_cart_tickets, \
+    get_event_availability, RedisInventory
 from event.permissions import IsHostOrReadOnly, IsBookingOwner
 from event.queue_service import QueueService
 from event.serializers import EventSerializer, CategorySerializer, TicketBatchSerializer, BookingSerializer, \
-    QrCodeSerializer
-from event.models import Event, Category, TicketBatch, Booking, BookingToken
+    QrCodeSerializer, CartSerializer, CancellationJobSerializer
+from event.models import Event, Category, TicketBatch, TicketBatchSlot, Booking, CancellationJob
+from event.stock_cache import StockCache
+from event.tasks import reconcile_ticket_batch_inventory, run_cancellation_job
 
 
-class CategoryViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
+class CategoryViewSet(ConditionalGetMixin, viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
 
+    @conditional
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @conditional
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
-class EventViewSet(viewsets.ModelViewSet):
+
+class EventViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Event.objects.all().order_by('-id')
     serializer_class = EventSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly, IsHostOrReadOnly]
@@ -27,19 +47,48 @@ class EventViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(host=self.request.user)
 
-    @method_decorator(cache_page(60 * 5))
+    @conditional
+    @cache_response('event')
     def retrieve(self, request, *args, **kwargs):
         """
         Cache the retrieve action for event details
         """
         return super().retrieve(request, *args, **kwargs)
 
-    @method_decorator(cache_page(60 * 5))
+    @conditional
+    @cache_response('event')
     def list(self, request, *args, **kwargs):
         """
-        Cache the list action for all events
+        Cache the list action for all events,
+        the page only reads IDs and every event is serialized once per change.
         """
-        return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset()).values_list('id', 'updated_at')
+        page = self.paginate_queryset(queryset)
+        data = get_fragments('event', queryset if page is None else page, self.serialize_events)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def serialize_events(self, ids):
+        return self.get_serializer(Event.objects.filter(id__in=ids), many=True).data
+
+    @action(
+        detail=True,
+        methods=['post'],
+        url_path='cancel',
+        url_name='cancel',
+        permission_classes=[permissions.IsAuthenticated, IsHostOrReadOnly]
+    )
+    def cancel(self, request, pk=None):
+        """
+        stop sales and cancel all bookings of the event in a background job.
+        """
+        event = self.get_object()
+        if event.cancelled_at:
+            raise ValidationError("The event is already cancelled.")
+        job = start_cancellation(event, self.request.user)
+        run_cancellation_job.delay(job.id)
+        return Response(CancellationJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
 
     @action(
         detail=True,
@@ -48,6 +97,7 @@ class EventViewSet(viewsets.ModelViewSet):
         url_name='start_booking',
         permission_classes=[permissions.IsAuthenticated]
     )
+    @idempotent
     def start_booking(self, request, pk=None):
         """
         if event queue is active, add user to queue
@@ -56,16 +106,58 @@ class EventViewSet(viewsets.ModelViewSet):
         user = self.request.user
         event = self.get_object()
         if event.active_queue:
-            booking_token = BookingToken.objects.filter(user=user, event=event).first()
-            if booking_token and booking_token.is_valid():
+            queue_service = QueueService(event=event.id, shards=event.queue_shards)
+            if queue_service.get_booking_token(str(user.id)):
                 return Response({"message": "You are allowed to continue booking"}, status=status.HTTP_200_OK)
-            queue_service = QueueService(event=event.id)
             if queue_service.add_to_queue(str(user.id)):
                 return Response({"message": "You have been added to the waiting room"}, status=status.HTTP_201_CREATED)
             return Response({"message": "You are already in the queue"}, status=status.HTTP_400_BAD_REQUEST)
         return Response({"message": "The EventQueue is not active, You are allowed to continue booking"},
                         status=status.HTTP_200_OK)
 
+    @action(
+        detail=True,
+        methods=['get'],
+        url_path='availability',
+        url_name='availability',
+        permission_classes=[permissions.AllowAny],
+        authentication_classes=[],
+    )
+    def availability(self, request, pk=None):
+        """
+        tickets left in every ticket batch of the event, read from Redis so pollers never reach the database,
+        clients and proxies may reuse the response for AVAILABILITY_MAX_AGE seconds.
+        """
+        try:
+            remaining = get_event_availability(int(pk))
+        except ValueError:
+            remaining = None
+        if remaining is None:
+            raise NotFound("Event not found.")
+        response = Response([
+            {"ticket_batch": ticket_batch_id, "remaining": max(tickets_left, 0), "sold_out": tickets_left <= 0}
+            for ticket_batch_id, tickets_left in sorted(remaining.items())
+        ], status=status.HTTP_200_OK)
+        response['Cache-Control'] = f"public, max-age={settings.AVAILABILITY_MAX_AGE}"
+        return response
+
+    @action(
+        detail=True,
+        methods=['post'],
+        url_path='leave_queue',
+        url_name='leave_queue',
+        permission_classes=[permissions.IsAuthenticated]
+    )
+    def leave_queue(self, request, pk=None):
+        """
+        remove user from the event's waiting room.
+        """
+        event = self.get_object()
+        queue_service = QueueService(event=event.id, shards=event.queue_shards)
+        if queue_service.leave_queue(str(self.request.user.id)):
+            return Response({"message": "You have left the queue"}, status=status.HTTP_200_OK)
+        return Response({"message": "You are not in the queue"}, status=status.HTTP_400_BAD_REQUEST)
+
     @action(
         detail=True,
         methods=['post'],
@@ -74,41 +166,148 @@ class EventViewSet(viewsets.ModelViewSet):
         url_name='booking',
         permission_classes=[permissions.IsAuthenticated]
     )
+    @idempotent
     def booking(self, request, pk=None):
         """
         check and validate booking tokens if event queue is active.
-        there is used transaction.atomic() to avoid race condition.
+        there is used transaction.atomic() to avoid race condition,
+        database inventory batches are booked by the BOOKING_ENGINE,
+        with the kafka engine they answer 202 Accepted and a status URL.
+        batches with the redis inventory mode are reserved in Redis and
+        saved to the database shortly after, so they answer 202 Accepted.
+        """
+        return self.create_booking(request)
+
+    @action(
+        detail=True,
+        methods=['post'],
+        serializer_class=BookingSerializer,
+        url_path='reserve',
+        url_name='reserve',
+        permission_classes=[permissions.IsAuthenticated]
+    )
+    @idempotent
+    def reserve(self, request, pk=None):
+        """
+        hold tickets as a pending booking for BOOKING_HOLD_TIME seconds,
+        the hold is confirmed with /api/booking/<id>/confirm/ or released by the hold sweeper.
+        """
+        return self.create_booking(request, hold_expires_at=now() + timedelta(seconds=settings.BOOKING_HOLD_TIME))
+
+    @action(
+        detail=True,
+        methods=['post'],
+        serializer_class=CartSerializer,
+        url_path='cart',
+        url_name='cart',
+        permission_classes=[permissions.IsAuthenticated]
+    )
+    @idempotent
+    def cart(self, request, pk=None):
+        """
+        book several ticket batches of the event in one transaction,
+        all bookings are inserted with a single bulk_create.
         """
         event = self.get_object()
         user = self.request.user
+        queue_service = self.check_booking_token(event, user)
+
+        serializer = self.get_serializer(data=request.data, context={'event': event, 'user': user})
+        serializer.is_valid(raise_exception=True)
+
+        items = serializer.validated_data['items']
+        confirmed_at = now()
+        with transaction.atomic():
+            take_cart_tickets(items)
+            bookings = Booking.objects.bulk_create([
+                Booking(
+                    user=user,
+                    event=event,
+                    ticket_batch=item['ticket_batch'],
+                    ticket_count=item['ticket_count'],
+                    payment_status=Booking.BookingStatusChoices.CONFIRMED,
+                    confirmed_at=confirmed_at,
+                )
+                for item in items
+            ])
+
         if event.active_queue:
-            queue_token = BookingToken.objects.filter(user=user, event=event).first()
-            if not queue_token:
-                raise PermissionDenied("Queue Token is required to continue booking.")
-            if not queue_token.is_valid():
-                print("Queue Token is expired.")
-                raise PermissionDenied("Queue Token is expired.")
+            queue_service.record_checkout(str(user.id))
+        return Response(BookingSerializer(bookings, many=True).data, status=status.HTTP_201_CREATED)
+
+    def check_booking_token(self, event, user):
+        queue_service = QueueService(event=event.id, shards=event.queue_shards)
+        if event.active_queue and not queue_service.get_booking_token(str(user.id)):
+            raise PermissionDenied("A valid Queue Token is required to continue booking.")
+        return queue_service
+
+    def create_booking(self, request, hold_expires_at=None):
+        stock_cache = self.check_stock_cache(request)
+        event = self.get_object()
+        user = self.request.user
+        queue_service = self.check_booking_token(event, user)
 
         serializer = self.get_serializer(data=request.data, context={'event': event, 'user': user})
         serializer.is_valid(raise_exception=True)
 
+        try:
+            response, remaining = self.book_ticket_batch(request, event, user, serializer, hold_expires_at)
+        except ValidationError as e:
+            if stock_cache and 'sold_out' in e.get_codes():
+                stock_cache.publish(0)
+            raise
+        if stock_cache and remaining is not None:
+            stock_cache.publish(remaining)
+
+        if event.active_queue:
+            queue_service.record_checkout(str(user.id))
+        return response
+
+    def check_stock_cache(self, request):
+        """
+        Reject bookings of sold-out batches before any SQL runs.
+        """
+        try:
+            ticket_batch_id = int(request.data.get('ticket_batch'))
+            ticket_count = int(request.data.get('ticket_count', 1))
+        except (TypeError, ValueError):
+            return None
+        stock_cache = StockCache(ticket_batch_id)
+        stock_cache.check(ticket_count)
+        return stock_cache
+
+    def book_ticket_batch(self, request, event, user, serializer, hold_expires_at):
+        """
+        Book with the ticket batch's inventory mode.
+        :return: the response and the tickets left in the batch, if the booking path knows them.
+        """
         ticket_batch = serializer.validated_data['ticket_batch']
         ticket_count = serializer.validated_data['ticket_count']
-        try:
+        if ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.REDIS:
+            booking, remaining = reserve_booking(event, user, ticket_batch, ticket_count, hold_expires_at)
+            return Response(self.get_serializer(booking).data, status=status.HTTP_202_ACCEPTED), remaining
+        if ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.SHARDED:
             with transaction.atomic():
-                ticket_batch = TicketBatch.objects.select_for_update().get(id=ticket_batch.id)
-                if ticket_batch.tickets_sold + ticket_count > ticket_batch.number_of_tickets:
-                    raise ValidationError("Not enough tickets available for booking.")
-                if ticket_batch.tickets_sold == ticket_batch.number_of_tickets:
-                    raise ValidationError("Ticket batch is sold out.")
-                ticket_batch.tickets_sold = F('tickets_sold') + ticket_count
-                ticket_batch.save()
-                serializer.save(event=event, user=user)
-                return Response(serializer.data, status=status.HTTP_201_CREATED)
+                take_slot_tickets(ticket_batch, ticket_count)
+                serializer.save(event=event, user=user, hold_expires_at=hold_expires_at)
+            return Response(serializer.data, status=status.HTTP_201_CREATED), None
+        if settings.BOOKING_ENGINE == 'kafka':
+            reference_code = submit_booking(event, user, ticket_batch, ticket_count, hold_expires_at)
+            return Response({
+                "reference_code": reference_code,
+                "status_url": reverse('booking-status', kwargs={'reference_code': reference_code}, request=request),
+            }, status=status.HTTP_202_ACCEPTED), None
+
+        try:
+            booking = get_booking_engine().book(event, user, ticket_batch, ticket_count, hold_expires_at)
         except TicketBatch.DoesNotExist:
             raise ValidationError("The ticket batch for this event does not exist.")
+        except ValidationError:
+            raise
         except Exception as e:
             raise ValidationError("An error occurred while processing your booking.", e)
+        remaining = booking.ticket_batch.number_of_tickets - booking.ticket_batch.tickets_sold
+        return Response(self.get_serializer(booking).data, status=status.HTTP_201_CREATED), remaining
 
     @action(
         detail=True,
@@ -120,26 +319,19 @@ class EventViewSet(viewsets.ModelViewSet):
     def queue(self, request, pk=None):
         """
         waiting room imitation, return users' position in queue.
-        if user is in allowed users return booking token.
+        if user was admitted return booking token.
         """
         user = self.request.user
         event = self.get_object()
-        queue_service = QueueService(event=event.id)
-        position = queue_service.get_user_position(str(user.id))
-        allowed_users = queue_service.get_allowed_users()
-
-        if str(user.id) in allowed_users:
-            try:
-                booking_token = BookingToken.objects.get(user=user, event=event)
-            except BookingToken.DoesNotExist:
-                booking_token = None
-            if booking_token:
-                booking_token = booking_token.token
-                return Response(
-                    {"message": "You are allowed to start the booking",
-                     "booking_token": booking_token},
-                    status=status.HTTP_200_OK,
-                )
+        queue_service = QueueService(event=event.id, shards=event.queue_shards)
+        position, booking_token = queue_service.get_queue_status(str(user.id))
+
+        if booking_token:
+            return Response(
+                {"message": "You are allowed to start the booking",
+                 "booking_token": booking_token},
+                status=status.HTTP_200_OK,
+            )
 
         return Response(
             {"message": "Your are in the queue", "position": position},
@@ -147,11 +339,91 @@ class EventViewSet(viewsets.ModelViewSet):
         )
 
 
-class TicketBatchViewSet(viewsets.ModelViewSet):
-    queryset = TicketBatch.objects.all()
+class TicketBatchViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
+    queryset = TicketBatch.objects.prefetch_related('slots')
     serializer_class = TicketBatchSerializer
     permission_classes = [permissions.IsAuthenticated, IsHostOrReadOnly]
 
+    def get_validator_state(self, queryset):
+        """
+        Bookings change tickets_sold without saving the batch, so the ETag also carries
+        the tickets sold of the batches and their slots, and no Last-Modified is sent.
+        """
+        state = queryset.aggregate(count=Count('id'), updated_at=Max('updated_at'), tickets_sold=Sum('tickets_sold'))
+        state.update(TicketBatchSlot.objects.filter(ticket_batch__in=queryset).aggregate(
+            slots_sold=Sum('tickets_sold')
+        ))
+        return state
+
+    @conditional
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @conditional
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            ticket_batch = serializer.save()
+            if ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.SHARDED:
+                distribute_slots(ticket_batch)
+            if ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.REDIS:
+                # Seed the counter up front, so the first bookings do not all miss it.
+                transaction.on_commit(lambda: RedisInventory(ticket_batch.id).sync(
+                    ticket_batch.number_of_tickets, only_if_missing=True,
+                ))
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            ticket_batch = serializer.save()
+            if ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.SHARDED:
+                distribute_slots(ticket_batch)
+        if ticket_batch.inventory_mode == TicketBatch.InventoryModeChoices.REDIS:
+            reconcile_ticket_batch_inventory.delay(ticket_batch.id)
+
+    @action(
+        detail=True,
+        methods=['post'],
+        url_path='cancel',
+        url_name='cancel'
+    )
+    def cancel(self, request, pk=None):
+        """
+        stop sales and cancel all bookings of the ticket batch in a background job.
+        """
+        ticket_batch = self.get_object()
+        if ticket_batch.cancelled_at:
+            raise ValidationError("The ticket batch is already cancelled.")
+        job = start_cancellation(ticket_batch.event, self.request.user, ticket_batch)
+        run_cancellation_job.delay(job.id)
+        return Response(CancellationJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+class CancellationJobViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
+    queryset = CancellationJob.objects.all().order_by('-id')
+    serializer_class = CancellationJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return self.queryset.filter(event__host=self.request.user)
+
+    @action(
+        detail=True,
+        methods=['post'],
+        url_path='resume',
+        url_name='resume'
+    )
+    def resume(self, request, pk=None):
+        """
+        run an interrupted or failed cancellation job again, it continues after the last cancelled chunk.
+        """
+        job = self.get_object()
+        if job.status == CancellationJob.StatusChoices.COMPLETED:
+            raise ValidationError("The cancellation job is already completed.")
+        run_cancellation_job.delay(job.id)
+        return Response(self.get_serializer(job).data, status=status.HTTP_202_ACCEPTED)
+
 
 class BookingViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
     queryset = Booking.objects.all().order_by('-id')
@@ -175,3 +447,46 @@ class BookingViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Retr
         booking = self.get_object()
         serializer = self.get_serializer(booking)
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @action(
+        detail=False,
+        methods=['get'],
+        url_path=r'status/(?P<reference_code>[0-9a-f-]{36})',
+        url_name='status'
+    )
+    def booking_status(self, request, reference_code=None):
+        """
+        status of a booking submitted with the kafka engine: queued, rejected or booked.
+        """
+        booking = Booking.objects.filter(reference_code=reference_code, user=request.user).first()
+        if booking:
+            return Response({"status": "booked", "booking": self.get_serializer(booking).data},
+                            status=status.HTTP_200_OK)
+        booking_status = get_booking_status(reference_code)
+        if booking_status is None or booking_status['user'] != request.user.id:
+            raise NotFound("Booking not found.")
+        return Response({"status": booking_status['status'], "detail": booking_status['detail']},
+                        status=status.HTTP_200_OK)
+
+    @action(
+        detail=True,
+        methods=['post'],
+        permission_classes=[permissions.IsAuthenticated, IsBookingOwner],
+        url_path='confirm',
+        url_name='confirm'
+    )
+    def confirm(self, request, pk=None):
+        """
+        confirm a held booking before its hold expires.
+        """
+        booking = self.get_object()
+        confirmed = Booking.objects.filter(
+            id=booking.id,
+            payment_status=Booking.BookingStatusChoices.PENDING,
+            hold_expires_at__gt=now(),
+        ).update(payment_status=Booking.BookingStatusChoices.CONFIRMED, confirmed_at=now(), hold_expires_at=None)
+        if not confirmed:
+            raise ValidationError("The booking is not held or its hold has expired.")
+        booking.refresh_from_db()
+        serializer = self.get_serializer(booking)
+        return Response(serializer.data, status=status.HTTP_200_OK)
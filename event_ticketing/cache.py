@@ -0,0 +1,202 @@
+import functools
+import hashlib
+import math
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+# Cached responses stay readable this many seconds past their expiry, so requests that lose the
+# rebuild lock can serve the stale copy while one request rebuilds it.
+STALE_GRACE = 60
+EARLY_REFRESH_BETA = 1.0
+REBUILD_LOCK_TIMEOUT = 30
+REBUILD_WAIT = 5
+POLL_INTERVAL = 0.05
+
+
+def get_version_key(resource):
+    return f"cache_version:{resource}"
+
+
+def get_cache_version(resource):
+    """
+    Current version of a resource's cached responses. A missing counter starts from the clock,
+    so a counter lost to eviction never comes back to a version that still has entries cached.
+    """
+    return cache.get_or_set(get_version_key(resource), time.time_ns(), timeout=None)
+
+
+def bump_cache_version(resource):
+    """
+    Invalidate every cached response of the resource, whatever its path or query string,
+    by moving its counter once the current transaction commits.
+    """
+    def bump():
+        try:
+            cache.incr(get_version_key(resource))
+        except ValueError:
+            cache.set(get_version_key(resource), time.time_ns(), timeout=None)
+
+    transaction.on_commit(bump)
+
+
+def get_response_key(request, resource):
+    # The host is part of the key because paginated responses carry absolute next/previous links.
+    path = f"{request.get_host()}{request.get_full_path()}"
+    return f"view:{resource}:{get_cache_version(resource)}:{hashlib.sha256(path.encode()).hexdigest()}"
+
+
+def get_fragments(resource, rows, serialize):
+    """
+    Serialized objects cached one by one. The key of an object carries its `updated_at`,
+    so an edited object misses on its own while the rest of the page is still served from the cache.
+    :param resource: Prefix of the fragment keys.
+    :param rows: (id, updated_at) pairs in the order of the response.
+    :param serialize: Callable returning the serialized dicts of the given IDs.
+    :return: The serialized objects in the order of `rows`.
+    """
+    keys = {pk: f"fragment:{resource}:{pk}:{updated_at.timestamp()}" for pk, updated_at in rows}
+    fragments = cache.get_many(list(keys.values()))
+    missing = [pk for pk, key in keys.items() if key not in fragments]
+    if missing:
+        fresh = {keys[item['id']]: item for item in serialize(missing)}
+        cache.set_many(fresh, settings.VIEW_CACHE_TIMEOUT)
+        fragments.update(fresh)
+    # Objects deleted since the IDs were read are left out.
+    return [fragments[keys[pk]] for pk, _ in rows if keys[pk] in fragments]
+
+
+def should_refresh(entry):
+    """
+    Probabilistic early refresh. The closer an entry is to its expiry and the longer it took
+    to build, the likelier a request rebuilds it ahead of time, so a hot entry is rebuilt
+    by one request before it expires instead of by every request after.
+    """
+    return time.time() - entry['delta'] * EARLY_REFRESH_BETA * math.log(1 - random.random()) >= entry['expires']
+
+
+def wait_for_entry(key):
+    deadline = time.monotonic() + REBUILD_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+
+def cache_response(resource, timeout=None):
+    """
+    Cache successful responses of a viewset action under the resource's current version.
+    The data is cached before rendering, so every client still gets its own content negotiation.
+    Only the request holding the rebuild lock runs the action for an expiring or missing entry,
+    the others serve the stale copy, or wait for the rebuilt one if there is none.
+    :param resource: Name of the version counter, bumped by bump_cache_version on every change.
+    :param timeout: Seconds to keep a response, defaults to VIEW_CACHE_TIMEOUT.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(self, request, *args, **kwargs):
+            key = get_response_key(request, resource)
+            entry = cache.get(key)
+            if entry is not None and not should_refresh(entry):
+                return Response(entry['data'])
+
+            lock_key = f"{key}:rebuild"
+            rebuilding = cache.add(lock_key, 1, REBUILD_LOCK_TIMEOUT)
+            if not rebuilding:
+                if entry is None:
+                    entry = wait_for_entry(key)
+                if entry is not None:
+                    return Response(entry['data'])
+                # The rebuild is stuck or failed, build the response without the lock.
+
+            try:
+                started = time.monotonic()
+                response = view(self, request, *args, **kwargs)
+                if response.status_code == 200:
+                    expires_in = timeout or settings.VIEW_CACHE_TIMEOUT
+                    cache.set(key, {
+                        "data": response.data,
+                        "delta": time.monotonic() - started,
+                        "expires": time.time() + expires_in,
+                    }, expires_in + STALE_GRACE)
+                return response
+            finally:
+                if rebuilding:
+                    cache.delete(lock_key)
+
+        return wrapper
+
+    return decorator
+
+
+class ConditionalGetMixin:
+    """
+    Validators of a viewset's list and detail responses, read with one aggregate query.
+    The count is part of the ETag, so a deleted object changes it even when no `updated_at` moves.
+    Lists send no Last-Modified for the same reason, an If-Modified-Since could not see the deletion.
+    """
+
+    def get_validated_queryset(self, pk=None):
+        queryset = self.filter_queryset(self.get_queryset())
+        if pk is not None:
+            queryset = queryset.filter(pk=pk)
+        return queryset
+
+    def get_validator_state(self, queryset):
+        """
+        Aggregates the ETag is built from, `last_modified` is also sent as Last-Modified of detail responses.
+        """
+        return queryset.aggregate(count=Count('id'), last_modified=Max('updated_at'))
+
+    def get_validators(self, pk=None):
+        """
+        :return: The ETag and the Last-Modified datetime of the response, either may be None.
+        """
+        try:
+            state = self.get_validator_state(self.get_validated_queryset(pk))
+        except (TypeError, ValueError, ValidationError):
+            # A malformed pk, the action answers 404 itself.
+            return None, None
+        if not state['count']:
+            return None, None
+        last_modified = state.get('last_modified') if pk is not None else None
+        return '-'.join(str(value) for value in state.values()), last_modified
+
+
+def conditional(view):
+    """
+    Answer a conditional GET of a ConditionalGetMixin viewset action with 304 Not Modified
+    before the action queries or serializes anything, and send the validators with the response.
+    """
+    @functools.wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(kwargs.get('pk'))
+        headers = {}
+        if etag is not None:
+            # Weak, the same data is rendered as JSON or as the browsable API.
+            etag = f"W/{quote_etag(hashlib.md5(etag.encode()).hexdigest())}"
+            headers['ETag'] = etag
+        if last_modified is not None:
+            last_modified = int(last_modified.timestamp())
+            headers['Last-Modified'] = http_date(last_modified)
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view(self, request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    return wrapper
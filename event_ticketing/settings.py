@@ -189,6 +189,14 @@ EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 REDIS_HOST = env("REDIS_HOST")
 REDIS_PORT = env("REDIS_PORT")
 
+# Process-wide connection pool used by the event queue (event.redis_client)
+REDIS_QUEUE_DB = env.int("REDIS_QUEUE_DB", default=0)
+REDIS_POOL_MAX_CONNECTIONS = env.int("REDIS_POOL_MAX_CONNECTIONS", default=50)
+REDIS_POOL_TIMEOUT = env.float("REDIS_POOL_TIMEOUT", default=2.0)
+REDIS_SOCKET_TIMEOUT = env.float("REDIS_SOCKET_TIMEOUT", default=1.0)
+REDIS_SOCKET_CONNECT_TIMEOUT = env.float("REDIS_SOCKET_CONNECT_TIMEOUT", default=1.0)
+REDIS_HEALTH_CHECK_INTERVAL = env.int("REDIS_HEALTH_CHECK_INTERVAL", default=30)
+
 CACHES = {
     'default': {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -199,6 +207,10 @@ CACHES = {
     }
 }
 
+# Seconds cached responses of the event and social media endpoints are kept. Every change bumps the
+# resource's version in event_ticketing.cache, so this only bounds memory, not staleness.
+VIEW_CACHE_TIMEOUT = env.int("VIEW_CACHE_TIMEOUT", default=6 * 60 * 60)
+
 CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}'
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
 CELERY_TASK_SERIALIZER = 'json'
@@ -207,11 +219,67 @@ CELERY_TIMEZONE = 'UTC'
 DJANGO_CELERY_BEAT_TZ_AWARE = False
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 
+# How often active queues are checked for a due admission tick, the per-event
+# tick (Event.admission_tick_seconds) is rounded up to this resolution.
+ADMISSION_DISPATCH_INTERVAL = 1.0
+
+# Write-behind of bookings reserved in Redis (TicketBatch.inventory_mode `redis`) and
+# the reconciliation of their counters with the database.
+INVENTORY_FLUSH_INTERVAL = 1.0
+INVENTORY_RECONCILE_INTERVAL = 300.0
+
+# How bookings of database inventory batches are written (event.booking_engine): `direct` locks the
+# TicketBatch row per request, `single_statement` books with one conditional UPDATE and INSERT
+# statement, `group_commit` coalesces concurrent bookings of a batch in each process
+# for BOOKING_GROUP_COMMIT_WINDOW seconds and commits them together, `kafka` publishes booking commands
+# (event.booking_commands) that the consume_bookings command applies.
+BOOKING_ENGINE = env("BOOKING_ENGINE", default="direct")
+BOOKING_GROUP_COMMIT_WINDOW = env.float("BOOKING_GROUP_COMMIT_WINDOW", default=0.005)
+BOOKING_GROUP_COMMIT_MAX_SIZE = env.int("BOOKING_GROUP_COMMIT_MAX_SIZE", default=500)
+BOOKING_GROUP_COMMIT_TIMEOUT = env.float("BOOKING_GROUP_COMMIT_TIMEOUT", default=10.0)
+
+# Booking commands of the kafka engine. BOOKING_COMMAND_LOG `memory` keeps them in process for tests,
+# partitioned into KAFKA_BOOKING_PARTITIONS lists.
+BOOKING_COMMAND_LOG = env("BOOKING_COMMAND_LOG", default="kafka")
+KAFKA_BOOTSTRAP_SERVERS = env("KAFKA_BOOTSTRAP_SERVERS", default="localhost:9092")
+KAFKA_BOOKING_TOPIC = env("KAFKA_BOOKING_TOPIC", default="booking-commands")
+KAFKA_BOOKING_GROUP = env("KAFKA_BOOKING_GROUP", default="booking-consumers")
+KAFKA_BOOKING_PARTITIONS = env.int("KAFKA_BOOKING_PARTITIONS", default=8)
+KAFKA_PRODUCE_TIMEOUT = env.float("KAFKA_PRODUCE_TIMEOUT", default=5.0)
+BOOKING_STATUS_TTL = 60 * 60
+
+# Tickets reserved with /api/event/<id>/reserve/ are held as a pending booking for
+# BOOKING_HOLD_TIME seconds, expired holds are released every HOLD_SWEEP_INTERVAL seconds.
+BOOKING_HOLD_TIME = 300
+HOLD_SWEEP_INTERVAL = 10.0
+HOLD_SWEEP_LIMIT = 5000
+
+# Seconds clients and proxies may reuse a response of /api/event/<id>/availability/.
+AVAILABILITY_MAX_AGE = 1
+
+# Bookings cancelled per transaction by a cancellation job.
+CANCELLATION_CHUNK_SIZE = 1000
+
+# Responses of booking endpoints sent with an Idempotency-Key header are replayed for this many seconds.
+IDEMPOTENCY_KEY_TTL = 10 * 60
+
 CELERY_BEAT_SCHEDULE = {
     "process_event_queue": {
         "task": "event.tasks.process_event_queue",
-        "schedule": 600.0,
-    }
+        "schedule": ADMISSION_DISPATCH_INTERVAL,
+    },
+    "flush_pending_bookings": {
+        "task": "event.tasks.flush_pending_bookings",
+        "schedule": INVENTORY_FLUSH_INTERVAL,
+    },
+    "reconcile_inventory": {
+        "task": "event.tasks.reconcile_inventory",
+        "schedule": INVENTORY_RECONCILE_INTERVAL,
+    },
+    "release_booking_holds": {
+        "task": "event.tasks.release_booking_holds",
+        "schedule": HOLD_SWEEP_INTERVAL,
+    },
 }
 
 TESTING = "test" in sys.argv